@@ -0,0 +1,173 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from testit_stub import start_testit_stub
+from student_server import make_items
+
+# Offline benchmark of grader.py: builds a fake /autograder layout, runs the grader's main() and setup() against a
+# local stand-in testit server and student server, and reports wall time, tests/second and peak RSS
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+GRADER_DIR = os.path.join(BENCHMARK_DIR, "..", "test-grader")
+
+
+def get_free_port():
+  with socket.socket() as sock:
+    sock.bind(("localhost", 0))
+    return sock.getsockname()[1]
+
+
+def make_tests(count, port, prefix="Benchmark test"):
+  # Mix of small text tests, POSTs and large any-order JSON bodies
+  tests = []
+  for i in range(count):
+    name = f"{prefix} {i}"
+    if i % 10 == 0:
+      size = 2000
+      test = {"command": f"curl -s http://localhost:{port}/items/{size}", "response-type": "json", "any-order": True, "response": {"status": 200, "json": sorted(make_items(size), key=lambda item: item["id"])}}
+    elif i % 3 == 0:
+      body = json.dumps({"index": i})
+      test = {"command": f"curl -s -X POST -H 'Content-Type: application/json' -d '{body}' http://localhost:{port}/echo", "response-type": "json", "response": {"status": 201, "json": {"index": i}}}
+    elif i % 7 == 0:
+      test = {"command": f"curl -s http://localhost:{port}/missing", "response-type": "text", "response": {"status": 404, "body": "Not found"}}
+    else:
+      test = {"command": f"curl -s http://localhost:{port}/", "response-type": "text", "response": {"status": 200, "body": "SERVER TEST"}}
+    tests.append({"name": name, "type": "curl", "public": True, "test": test})
+  return tests
+
+
+def build_autograder(root, count, port, config_overrides):
+  source = os.path.join(root, "source")
+  os.makedirs(os.path.join(source, "test-grader"))
+  os.makedirs(os.path.join(root, "results"))
+  with open(os.path.join(GRADER_DIR, "config.json"), 'r') as file:
+    config = json.load(file)
+  config.update({"assignmentTitle": "benchmark", "waitTimeAfterPreTest": 0, "readinessProbe": {"port": port, "timeout": 30}, "maxNumReturnedTests": max(count, 100)})
+  config.update(config_overrides)
+  for key in ["parallelPhases", "batch"]:
+    if config.get(key) is not None:
+      config[key].setdefault("port", port) # the port written in the generated tests
+  with open(os.path.join(source, "test-grader", "config.json"), 'w') as file:
+    json.dump(config, file)
+
+  for directory in [os.path.join(source, "sample-submission"), os.path.join(root, "submission")]:
+    os.makedirs(directory)
+    shutil.copy(os.path.join(BENCHMARK_DIR, "student_server.py"), directory)
+  sample = os.path.join(source, "sample-submission")
+  with open(os.path.join(sample, "pre-test.sh"), 'w') as file:
+    file.write("#!/bin/bash\n\npython3 student_server.py &\n")
+  with open(os.path.join(sample, "post-test.sh"), 'w') as file:
+    file.write("#!/bin/bash\n")
+  with open(os.path.join(sample, "default-tests.json"), 'w') as file:
+    json.dump(make_tests(count, port, prefix="Default test"), file)
+  with open(os.path.join(root, "submission", "tests.json"), 'w') as file:
+    json.dump(make_tests(count, port), file)
+  with open(os.path.join(root, "submission_metadata.json"), 'w') as file:
+    json.dump({"assignment": {"title": "benchmark", "due_date": "2099-01-01T23:00:00.000000-05:00"}, "users": [{"email": "student@example.com"}]}, file)
+
+
+def build_batch(root, count, port, submissions):
+  # Copies of the submission from build_autograder, each with its own tests and student
+  batch = os.path.join(root, "batch")
+  for i in range(submissions):
+    directory = os.path.join(batch, f"submission-{i}")
+    os.makedirs(os.path.join(directory, "submission"))
+    shutil.copy(os.path.join(BENCHMARK_DIR, "student_server.py"), os.path.join(directory, "submission"))
+    with open(os.path.join(directory, "submission", "tests.json"), 'w') as file:
+      json.dump(make_tests(count, port, prefix=f"Student {i} test"), file)
+    with open(os.path.join(directory, "submission_metadata.json"), 'w') as file:
+      json.dump({"assignment": {"title": "benchmark", "due_date": "2099-01-01T23:00:00.000000-05:00"}, "users": [{"email": f"student{i}@example.com"}]}, file)
+  return batch
+
+
+def run_grader(root, args, testit_port, student_port):
+  env = dict(os.environ, AUTOGRADER_DIR=root, SERVER_IP="localhost", SERVER_PORT=str(testit_port), AUTH_TOKEN="benchmark", PORT=str(student_port))
+  cwd = os.path.join(root, "source", "sample-submission") if args[:1] == ["--setup"] else os.path.join(root, "submission")
+  start = time.perf_counter()
+  process = subprocess.Popen([sys.executable, os.path.join(GRADER_DIR, "grader.py")] + args, cwd=cwd, env=env, stdout=subprocess.DEVNULL)
+  _, status, rusage = os.wait4(process.pid, 0)
+  elapsed = time.perf_counter() - start
+  if status != 0:
+    raise RuntimeError(f"grader.py {' '.join(args)} exited with status {status}")
+  return elapsed, rusage.ru_maxrss / 1024 # ru_maxrss is in KiB on Linux
+
+
+def benchmark(count, config_overrides, keep, batch_size):
+  root = tempfile.mkdtemp(prefix=f"grader-bench-{count}-")
+  testit_server, state = start_testit_stub()
+  try:
+    student_port = get_free_port()
+    build_autograder(root, count, student_port, config_overrides)
+    testit_port = testit_server.server_address[1]
+
+    setup_time, setup_rss = run_grader(root, ["--setup"], testit_port, student_port)
+    main_time, main_rss = run_grader(root, [], testit_port, student_port)
+
+    with open(os.path.join(root, "results", "results.json"), 'r') as file:
+      main_tests = len(json.load(file)["tests"])
+    rows = [
+      {"run": "setup", "tests": count, "tests_run": count, "seconds": setup_time, "tests_per_second": count / setup_time, "peak_rss_mb": setup_rss},
+      {"run": "main", "tests": count, "tests_run": main_tests, "seconds": main_time, "tests_per_second": main_tests / main_time, "peak_rss_mb": main_rss},
+    ]
+    if batch_size > 0:
+      batch = build_batch(root, count, student_port, batch_size)
+      with open(os.path.join(root, "source", "test-grader", "config.json"), 'r') as file:
+        config = json.load(file)
+      config["batch"] = dict(config.get("batch") or {}, port=student_port)
+      with open(os.path.join(root, "source", "test-grader", "config.json"), 'w') as file:
+        json.dump(config, file)
+      batch_time, batch_rss = run_grader(root, ["--batch", batch], testit_port, student_port)
+      batch_tests = 0
+      for name in os.listdir(batch):
+        if os.path.isdir(os.path.join(batch, name)):
+          with open(os.path.join(batch, name, "results", "results.json"), 'r') as file:
+            batch_tests += len(json.load(file)["tests"])
+      rows.append({"run": "batch", "tests": count, "tests_run": batch_tests, "seconds": batch_time, "tests_per_second": batch_tests / batch_time, "peak_rss_mb": batch_rss})
+    return rows
+  finally:
+    testit_server.shutdown()
+    if keep:
+      print(f"Kept benchmark directory {root}")
+    else:
+      shutil.rmtree(root, ignore_errors=True)
+
+
+def parse_override(override):
+  key, _, value = override.partition("=")
+  try:
+    return key, json.loads(value)
+  except json.JSONDecodeError:
+    return key, value
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Offline benchmark of grader.py")
+  parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="numbers of tests in the generated tests.json files")
+  parser.add_argument("--config", action="append", default=[], metavar="KEY=VALUE", help="override a config.json value (VALUE is parsed as JSON if possible)")
+  parser.add_argument("--output", help="also write the results as JSON to this file")
+  parser.add_argument("--keep", action="store_true", help="keep the generated autograder directories")
+  parser.add_argument("--batch", type=int, default=0, metavar="N", help="also regrade N generated submissions with grader.py --batch")
+  args = parser.parse_args()
+
+  config_overrides = dict(parse_override(override) for override in args.config)
+  rows = []
+  for count in args.sizes:
+    rows += benchmark(count, config_overrides, args.keep, args.batch)
+
+  print(f"{'run':<6} {'tests':>6} {'run':>6} {'seconds':>9} {'tests/s':>9} {'peak RSS (MB)':>14}")
+  for row in rows:
+    print(f"{row['run']:<6} {row['tests']:>6} {row['tests_run']:>6} {row['seconds']:>9.2f} {row['tests_per_second']:>9.1f} {row['peak_rss_mb']:>14.1f}")
+  if args.output:
+    with open(args.output, 'w') as file:
+      json.dump({"config": config_overrides, "results": rows}, file, indent=2)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,60 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+# Runs the same curl tests with the subprocess and pooled engines against student_server.py, and checks that every test
+# passes or fails the same way with both. Tests run in order, so state that one engine carries between tests shows up here
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "test-grader"))
+import grader
+
+
+def get_free_port():
+  with socket.socket() as sock:
+    sock.bind(("localhost", 0))
+    return sock.getsockname()[1]
+
+
+def make_tests(port):
+  url = f"http://localhost:{port}"
+  def text_test(name, command, status, body):
+    return {"name": name, "type": "curl", "test": {"command": command, "response-type": "text", "response": {"status": status, "body": body}}}
+  return [
+    text_test("Login", f"curl -s {url}/login", 200, "Logged in"),
+    text_test("Cookies aren't kept between tests", f"curl -s {url}/whoami", 401, "Not logged in"),
+    text_test("Cookies are sent with -b", f"curl -s -b sid=abc {url}/whoami", 200, "abc"),
+    text_test("Cookies aren't kept across a redirect", f"curl -s -L {url}/login-redirect", 401, "Not logged in"),
+    text_test("Still not logged in", f"curl -s {url}/whoami", 401, "Not logged in"),
+    text_test("Not found", f"curl -s {url}/missing", 404, "Not found"),
+  ]
+
+
+def main():
+  port = get_free_port()
+  server = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, "student_server.py")], env=dict(os.environ, PORT=str(port)))
+  try:
+    time.sleep(0.5)
+    grader.config = {"cacheTestPlans": False}
+    plans, errors = grader.compile_tests(make_tests(port))
+    assert errors == [], errors
+    outcomes = {}
+    for engine in ["subprocess", "pooled"]:
+      grader.config = {"curlEngine": engine, "testTimeout": 10}
+      grader.http_session = None
+      outcomes[engine] = [grader.run_curl_test(plan)["success"] for plan in plans]
+    mismatches = [plan.name for plan, a, b in zip(plans, outcomes["subprocess"], outcomes["pooled"]) if a != b]
+    for plan, success in zip(plans, outcomes["subprocess"]):
+      print(f"{'passed' if success else 'failed'}: {plan.name}")
+    if len(mismatches) > 0:
+      print("The engines disagree on: " + ", ".join(mismatches))
+      sys.exit(1)
+    print("Both engines agree on every test")
+  finally:
+    server.kill()
+
+
+if __name__ == "__main__":
+  main()
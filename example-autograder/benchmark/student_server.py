@@ -0,0 +1,59 @@
+import json
+import os
+import random
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Tiny stand-in for a student's server, used as both the sample solution and the submission in benchmarks
+
+PORT = int(os.getenv('PORT', '3000'))
+
+
+def make_items(count):
+  items = [{"id": i, "name": f"item {i}", "tags": [f"tag-{j}" for j in range(i % 5)]} for i in range(count)]
+  random.Random(count).shuffle(items) # any-order tests expect these in a different order
+  return items
+
+
+class StudentHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  wbufsize = -1 # send the headers and body together, the handler flushes after each request
+
+  def log_message(self, format, *args):
+    pass
+
+  def send_body(self, status, body, content_type, headers=()):
+    data = body.encode('utf-8')
+    self.send_response(status)
+    self.send_header("Content-Type", content_type)
+    for header, value in headers:
+      self.send_header(header, value)
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def do_GET(self):
+    if self.path == "/":
+      self.send_body(200, "SERVER TEST", "text/html; charset=utf-8")
+    elif self.path.startswith("/items/"):
+      self.send_body(200, json.dumps(make_items(int(self.path[len("/items/"):]))), "application/json; charset=utf-8")
+    elif self.path == "/login":
+      self.send_body(200, "Logged in", "text/plain", [("Set-Cookie", "sid=abc; Path=/")])
+    elif self.path == "/login-redirect":
+      self.send_body(302, "", "text/plain", [("Set-Cookie", "sid=abc; Path=/"), ("Location", "/whoami")])
+    elif self.path == "/whoami":
+      # Only a request that sends the session cookie is logged in
+      if "sid=abc" in self.headers.get("Cookie", ""):
+        self.send_body(200, "abc", "text/plain")
+      else:
+        self.send_body(401, "Not logged in", "text/plain")
+    else:
+      self.send_body(404, "Not found", "text/html; charset=utf-8")
+
+  def do_POST(self):
+    length = int(self.headers.get("Content-Length", 0))
+    body = self.rfile.read(length).decode('utf-8')
+    self.send_body(201, body, self.headers.get("Content-Type", "text/plain"))
+
+
+if __name__ == "__main__":
+  ThreadingHTTPServer(("localhost", PORT), StudentHandler).serve_forever()
@@ -0,0 +1,129 @@
+import collections
+import gzip
+import hashlib
+import json
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# In-memory stand-in for the testit server's routes that the grader uses: /, /submit-tests, /submit-results and /submit-results-bulk
+
+
+class TestitState:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.tests = {} # assignment -> name -> test
+    self.results_received = 0
+    self.outcomes = collections.defaultdict(list) # test name -> whether it passed in each run
+    self.applied_keys = set() # (test name, key), like the real server each result uploaded again with the same key is only counted once
+    self.bulk_requests = 0
+
+
+def get_test_history(outcomes):
+  # Like getTestHistory in the real server
+  recent = outcomes[-20:]
+  flips = sum(1 for a, b in zip(recent, recent[1:]) if a != b)
+  return {"failureRate": round(1 - sum(outcomes) / len(outcomes), 3) if outcomes else 0, "flakiness": round(flips / (len(recent) - 1), 3) if len(recent) > 1 else 0}
+
+
+class TestitHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  wbufsize = -1
+  state = None
+
+  def log_message(self, format, *args):
+    pass
+
+  def send_json(self, status, data):
+    body = json.dumps(data).encode('utf-8')
+    compress = len(body) > 1024 and "gzip" in self.headers.get("Accept-Encoding", "")
+    if compress:
+      body = gzip.compress(body)
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    if compress:
+      self.send_header("Content-Encoding", "gzip")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def read_json(self):
+    length = int(self.headers.get("Content-Length", 0))
+    body = self.rfile.read(length)
+    if self.headers.get("Content-Encoding") == "gzip":
+      body = gzip.decompress(body)
+    return json.loads(body or b"null")
+
+  def do_GET(self):
+    if urlparse(self.path).path == "/":
+      self.send_json(200, "ok")
+    else:
+      self.send_json(404, "Not found")
+
+  def do_POST(self):
+    parts = urlparse(self.path).path.strip("/").split("/")
+    if len(parts) != 2:
+      self.send_json(404, "Not found")
+    elif parts[0] == "submit-tests":
+      self.submit_tests(parts[1], self.read_json())
+    elif parts[0] == "submit-results":
+      results = self.read_json()
+      key = parse_qs(urlparse(self.path).query).get("key", [None])[0]
+      self.send_json(200, {"success": True, "failedToUpdate": [], "duplicate": not self.record_results(key, results)})
+    elif parts[0] == "submit-results-bulk":
+      submissions = self.read_json()
+      with self.state.lock:
+        self.state.bulk_requests += 1
+      self.send_json(200, {"success": True, "submissions": [{"id": submission["id"], "success": True, "failedToUpdate": [], "duplicate": not self.record_results(submission.get("key"), submission["results"])} for submission in submissions]})
+    else:
+      self.send_json(404, "Not found")
+
+  def record_results(self, key, results):
+    # Returns whether any of the results were new
+    recorded = 0
+    with self.state.lock:
+      for result in results:
+        if key is not None and (result["name"], key) in self.state.applied_keys:
+          continue
+        if key is not None:
+          self.state.applied_keys.add((result["name"], key))
+        self.state.results_received += 1
+        self.state.outcomes[result["name"]].append(result["passed"])
+        recorded += 1
+    return recorded > 0 or key is None or len(results) == 0
+
+  def submit_tests(self, assignment, body):
+    # An object body lists the tests the grader already has, and only the others are sent back
+    tests, known_tests = (body, None) if isinstance(body, list) else (body["tests"], set(body["knownTests"]))
+    # Like the real server, tests from the admin account (id -1, "LTE=") are default tests
+    is_admin = "id=LTE%3D" in self.path or "id=LTE=" in self.path
+    created_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+    with self.state.lock:
+      stored = self.state.tests.setdefault(assignment, {})
+      for test in tests:
+        existing = stored.get(test["name"])
+        if existing is not None and all(existing.get(key) == value for key, value in test.items()):
+          continue # like the real server, identical tests aren't updated
+        stored[test["name"]] = {**test, "public": test.get("public", True), "isDefault": is_admin, "createdAt": created_at, "author": "admin" if is_admin else "student"}
+      all_tests = [{**test, "selfWritten": test["author"] == ("admin" if is_admin else "student")} for test in stored.values()]
+      history = {test["name"]: get_test_history(self.state.outcomes[test["name"]]) for test in all_tests}
+    all_tests.sort(key=lambda test: not test["isDefault"])
+    if known_tests is None:
+      self.send_json(201, {"success": True, "failedToAdd": [], "tests": all_tests, "history": history})
+      return
+    hashes = [hashlib.sha256(json.dumps(test, sort_keys=True).encode('utf-8')).hexdigest()[:32] for test in all_tests]
+    etag = '"' + hashlib.sha256(",".join(hashes).encode('utf-8')).hexdigest() + '"'
+    if self.headers.get("If-None-Match") == etag:
+      self.send_json(201, {"success": True, "failedToAdd": [], "etag": etag, "notModified": True, "history": history})
+    else:
+      new_tests = {test_hash: test for test_hash, test in zip(hashes, all_tests) if test_hash not in known_tests}
+      self.send_json(201, {"success": True, "failedToAdd": [], "etag": etag, "order": hashes, "newTests": new_tests, "history": history})
+
+
+def start_testit_stub(port=0):
+  state = TestitState()
+  handler = type("BoundTestitHandler", (TestitHandler,), {"state": state})
+  server = ThreadingHTTPServer(("localhost", port), handler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server, state
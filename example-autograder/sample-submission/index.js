@@ -1,6 +1,6 @@
 const express = require('express');
 const app = express();
-const port = 3000;
+const port = process.env.PORT || 3000;
 
 // This will probably be using React.js or some other framework in the future, this version is just to test
 // this is the sample server solution provided by the homework to run test cases against
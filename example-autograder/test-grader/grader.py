@@ -1,13 +1,35 @@
 import json
+import math
 import subprocess
 import requests
 import shlex
 import time, os, sys, signal
 import re
 import base64
+import gzip
+import binascii
 import xml.etree.ElementTree as ET
+import concurrent.futures
+import threading
+import hashlib
+import collections
+import socket
+import shutil
+import contextlib
+import copy
+import csv
+import http.cookiejar
+import functools
+import heapq
+import cProfile
+import pstats
+import queue
+import tempfile
+import random
+import uuid
 from datetime import datetime
 import pytz
+import urllib3
 
 
 SERVER_IP = os.getenv('SERVER_IP') # EC2 instance IP of database/server
@@ -15,165 +37,1325 @@ SERVER_PORT = os.getenv('SERVER_PORT', '3000')
 SERVER_URI = f"http://{SERVER_IP}:{SERVER_PORT}"
 AUTH_TOKEN = os.getenv('AUTH_TOKEN')
 
+AUTOGRADER_DIR = os.getenv('AUTOGRADER_DIR', '/autograder') # root of the Gradescope directory layout, can be changed to run the grader elsewhere
+SOURCE_DIR = f"{AUTOGRADER_DIR}/source"
+SAMPLE_DIR = f"{SOURCE_DIR}/sample-submission"
+SAMPLE_RUN_DIR = SAMPLE_DIR # where the sample solution's server is started, which is a copy of it in --batch workers
+SUBMISSION_DIR = f"{AUTOGRADER_DIR}/submission"
+RESULTS_DIR = f"{AUTOGRADER_DIR}/results"
+METADATA_FILE = f"{AUTOGRADER_DIR}/submission_metadata.json"
+
+
+trace_events = []
+trace_lock = threading.Lock()
+trace_start = time.perf_counter()
+
+@contextlib.contextmanager
+def timed(name, category, **args):
+  # Records a complete event in Chrome trace format (timestamps in microseconds since the grader started)
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    end = time.perf_counter()
+    with trace_lock:
+      trace_events.append({"name": name, "cat": category, "ph": "X", "ts": round((start - trace_start) * 1e6), "dur": round((end - start) * 1e6), "pid": os.getpid(), "tid": threading.get_ident(), "args": args})
+
+
+def traced(function):
+  @functools.wraps(function)
+  def wrapper(*args, **kwargs):
+    details = {}
+    paths = [arg for arg in args if isinstance(arg, str) and arg.startswith('/')]
+    if len(paths) > 0:
+      details["paths"] = paths
+    if len(args) > 0 and isinstance(args[0], list):
+      details["tests"] = len(args[0])
+    with timed(function.__name__, "phase", **details):
+      return function(*args, **kwargs)
+  return wrapper
+
+
+def get_timing_summary():
+  with trace_lock:
+    events = list(trace_events)
+  test_events = sorted((event for event in events if event["cat"] == "test"), key=lambda event: event["dur"], reverse=True)
+  return {
+    "total_seconds": round(time.perf_counter() - trace_start, 3),
+    "phases": [{"phase": event["name"], "seconds": round(event["dur"] / 1e6, 3), **event["args"]} for event in events if event["cat"] == "phase"],
+    "tests_run": len(test_events),
+    "test_seconds": round(sum(event["dur"] for event in test_events) / 1e6, 3),
+    "slowest_tests": [{"name": event["name"], "seconds": round(event["dur"] / 1e6, 3)} for event in test_events[:10]]
+  }
+
+
+def write_trace():
+  trace_file = config.get("traceFile", f'{RESULTS_DIR}/trace.json') if 'config' in globals() else f'{RESULTS_DIR}/trace.json'
+  try:
+    with trace_lock:
+      events = list(trace_events)
+    with open(trace_file, 'w') as file:
+      json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+  except OSError as e:
+    print(f"Could not write the trace file {trace_file}: {e}")
+
+
+grading_deadline = None
+budget_exceeded = threading.Event()
+active_process_groups = set()
+
+def start_grading_budget():
+  global grading_deadline
+  budget = config.get("gradingBudget")
+  if budget is None:
+    return
+  grading_deadline = time.monotonic() + budget
+  watchdog = threading.Timer(budget, stop_active_processes)
+  watchdog.daemon = True
+  watchdog.start()
+  # Last resort if something without a timeout is still stuck well after the budget ran out
+  last_resort = threading.Timer(budget + config.get("budgetGracePeriod", 60), exit_over_budget)
+  last_resort.daemon = True
+  last_resort.start()
+
+
+def stop_active_processes():
+  # Kill any servers or maven runs that are still going, so hung requests fail right away and the results can be written
+  budget_exceeded.set()
+  kill_active_process_groups()
+
+
+def kill_active_process_groups():
+  for pgid in list(active_process_groups):
+    try:
+      os.killpg(pgid, signal.SIGKILL)
+    except OSError:
+      pass
+    active_process_groups.discard(pgid)
+
+
+def exit_over_budget():
+  message = f"Grading did not finish within the time budget of {config['gradingBudget']} seconds. Please contact the assignment administrators."
+  print(message)
+  try:
+    if active_results_writer is not None:
+      active_results_writer.close(message) # keeps the results that were already written
+    elif 'metadata' in globals() and metadata:
+      write_output({"output": message, "tests": []})
+  finally:
+    os._exit(1)
+
+
+def bounded_timeout(timeout, minimum=0, deadline=None):
+  # Shortens a timeout so that it doesn't run past the grading budget, or the deadline of the current phase if one is given
+  deadlines = [d for d in [grading_deadline, deadline] if d is not None]
+  if len(deadlines) == 0:
+    return timeout
+  remaining = max(min(deadlines) - time.monotonic(), minimum)
+  return remaining if timeout is None else min(timeout, remaining)
+
+
+def get_skipped_result(plan):
+  return {"success": False, "reason": f"Test '{plan.label}' was skipped because grading ran out of time (the time budget is {config.get('gradingBudget')} seconds)", "transient": True}
+
+
+def get_phase_skipped_result(plan):
+  return {"success": False, "reason": f"Test '{plan.label}' was skipped because running the tests ran out of time (the phaseTimeout is {config.get('phaseTimeout', 600)} seconds)", "transient": True, "timedOut": True}
+
 
 def load_config():
   global config
-  with open('/autograder/source/test-grader/config.json', 'r') as file:
+  with open(f'{SOURCE_DIR}/test-grader/config.json', 'r') as file:
     config = json.load(file)
     required_config_vars = ['numPublicTestsForAccess', 'maxTestsPerStudent', 'maxNumReturnedTests', 'weightReturnedTests', 'pomPath', 'jUnitTestLocation', 'groupedDefaultTestsScore', 'submitTestsScore', 'timeToDeadline', 'waitTimeAfterPreTest']
     for var in required_config_vars:
       assert var in config, f"Missing config variable: '{var}'"
+  if batch_job is not None:
+    config.update(BATCH_CONFIG)
 
 
 def load_metadata():
   global metadata
   try:
-    with open('/autograder/submission_metadata.json', 'r') as file:
+    with open(METADATA_FILE, 'r') as file:
       metadata = json.load(file)
   except:
     metadata = []
 
 
-def compare_json(json1, json2, any_order):
-  if not any_order:
-    return json1 == json2
-  if type(json1) != type(json2):
-    return False
-  if isinstance(json1, dict):
-    if json1.keys() != json2.keys():
-      return False
-    return all(compare_json(json1[key], json2[key], any_order) for key in json1)
-  if isinstance(json1, list):
+def json_digest(value, any_order):
+  # Canonical digest of a json value, computed bottom up once per subtree. Lists are treated as multisets if any_order is set
+  if isinstance(value, dict):
+    parts = [b"{"] + [json.dumps(key).encode('utf-8') + json_digest(value[key], any_order) for key in sorted(value)]
+  elif isinstance(value, list):
+    items = [json_digest(item, any_order) for item in value]
     if any_order:
-      return all(any(compare_json(item1, item2, any_order) for item2 in json2) for item1 in json1) and all(any(compare_json(item2, item1, any_order) for item1 in json1) for item2 in json2)
-    return all(compare_json(item1, item2, any_order) for item1, item2 in zip(json1, json2))
-  return json1 == json2
-
+      items.sort()
+    parts = [b"["] + items
+  else:
+    parts = [json.dumps(value).encode('utf-8')]
+  return hashlib.blake2b(b"".join(parts), digest_size=16).digest()
+
+
+MAX_EXCERPT_LENGTH = 200
+
+def excerpt(value, limit=MAX_EXCERPT_LENGTH):
+  text = value if isinstance(value, str) else json.dumps(value)
+  if len(text) <= limit:
+    return text
+  return text[:limit] + f"... ({len(text)} characters total)"
+
+
+def get_json_path(path, key):
+  return f"{path}.{key}" if re.match(r'^[\w-]+$', key) else f"{path}[{json.dumps(key)}]"
+
+
+def find_json_difference(actual, expected, any_order, path="$"):
+  # Returns a short description of the first place actual differs from expected, or None if they match
+  if isinstance(actual, dict) and isinstance(expected, dict):
+    for key in expected:
+      if key not in actual:
+        return f"{path}: missing key {json.dumps(key)}"
+    for key in actual:
+      if key not in expected:
+        return f"{path}: unexpected key {json.dumps(key)}"
+    for key in expected:
+      difference = find_json_difference(actual[key], expected[key], any_order, get_json_path(path, key))
+      if difference is not None:
+        return difference
+    return None
+  if isinstance(actual, list) and isinstance(expected, list):
+    if any_order:
+      remaining = collections.Counter(json_digest(item, any_order) for item in actual)
+      for item in expected:
+        digest = json_digest(item, any_order)
+        if remaining[digest] == 0:
+          return f"{path}: expected element {excerpt(json.dumps(item))} was not found (in any order)"
+        remaining[digest] -= 1
+      for item in actual:
+        digest = json_digest(item, any_order)
+        if remaining[digest] > 0:
+          return f"{path}: unexpected element {excerpt(json.dumps(item))}"
+      return None
+    if len(actual) != len(expected):
+      return f"{path}: expected {len(expected)} elements, got {len(actual)}"
+    for i, (actual_item, expected_item) in enumerate(zip(actual, expected)):
+      difference = find_json_difference(actual_item, expected_item, any_order, f"{path}[{i}]")
+      if difference is not None:
+        return difference
+    return None
+  if (any_order and type(actual) != type(expected)) or actual != expected:
+    return f"{path}: expected {excerpt(json.dumps(expected))}, got {excerpt(json.dumps(actual))}"
+  return None
+
+
+DEFAULT_MAX_RESPONSE_BYTES = 10 * 1024 * 1024
+MAX_STDERR_BYTES = 64 * 1024
+
+class ResponseBody:
+  # A response body read in chunks, keeping at most limit bytes of it in memory along with the size and digest of all of it
+  __slots__ = ("limit", "holdback", "head", "size", "hasher", "started", "pending")
+
+  def __init__(self, limit, holdback=0):
+    self.limit = limit
+    self.holdback = holdback # bytes at the end that aren't part of the body (e.g. the status code curl writes after it)
+    self.head = bytearray()
+    self.size = 0
+    self.hasher = hashlib.sha256()
+    self.started = False
+    self.pending = b""
+
+  def feed(self, chunk):
+    if not self.started:
+      chunk = chunk.lstrip() # leading whitespace was always stripped from curl's output
+      if not chunk:
+        return
+      self.started = True
+    self.pending += chunk
+    if len(self.pending) > self.holdback:
+      cut = len(self.pending) - self.holdback
+      data, self.pending = self.pending[:cut], self.pending[cut:]
+      self.size += len(data)
+      self.hasher.update(data)
+      if len(self.head) < self.limit:
+        self.head += data[:self.limit - len(self.head)]
+
+  @property
+  def truncated(self):
+    return self.size > len(self.head)
+
+  @property
+  def text(self):
+    return self.head.decode('utf-8', errors='replace')
+
+  def matches(self, expected):
+    data = expected.encode('utf-8')
+    return len(data) == self.size and hashlib.sha256(data).digest() == self.hasher.digest()
+
+  def excerpt(self):
+    if not self.truncated:
+      return excerpt(self.text)
+    return self.text[:MAX_EXCERPT_LENGTH] + f"... ({self.size} bytes total)"
+
+
+# Short curl options that take an argument, and the long options they map to
+CURL_SHORT_OPTIONS = {'X': '--request', 'H': '--header', 'd': '--data', 'b': '--cookie', 'u': '--user', 'A': '--user-agent', 'e': '--referer', 'm': '--max-time'}
+CURL_SHORT_FLAGS = {'s': '--silent', 'S': '--show-error', 'L': '--location', 'k': '--insecure', 'g': '--globoff'}
+CURL_DATA_OPTIONS = ['--data', '--data-ascii', '--data-binary', '--data-raw']
+
+
+def parse_curl_args(args):
+  # Translates the common subset of curl flags into request arguments, returns None if the command can't be translated.
+  # Raises a ValueError if the command could never work, e.g. a --max-time that isn't a number
+  if len(args) == 0 or args[0] != "curl":
+    return None
+
+  options = []
+  i = 1
+  while i < len(args):
+    arg = args[i]
+    if arg.startswith('--'):
+      if '=' in arg:
+        return None # curl doesn't accept --option=value
+      if arg in ['--silent', '--show-error', '--location', '--insecure', '--globoff', '--compressed']:
+        options.append((arg, None))
+      elif i + 1 < len(args):
+        options.append((arg, args[i + 1]))
+        i += 1
+      else:
+        return None
+    elif arg.startswith('-') and len(arg) > 1:
+      j = 1
+      while j < len(arg):
+        if arg[j] in CURL_SHORT_FLAGS:
+          options.append((CURL_SHORT_FLAGS[arg[j]], None))
+          j += 1
+        elif arg[j] in CURL_SHORT_OPTIONS:
+          if j + 1 < len(arg):
+            options.append((CURL_SHORT_OPTIONS[arg[j]], arg[j + 1:]))
+          elif i + 1 < len(args):
+            options.append((CURL_SHORT_OPTIONS[arg[j]], args[i + 1]))
+            i += 1
+          else:
+            return None
+          break
+        else:
+          return None
+    else:
+      options.append(('--url', arg))
+    i += 1
+
+  request = {"method": None, "url": None, "headers": {}, "data": None, "allow_redirects": False, "verify": True, "timeout": None, "compressed": False}
+  default_headers = {}
+  globoff = False
+  for name, value in options:
+    if name == '--url':
+      if request["url"] is not None:
+        return None
+      request["url"] = value
+    elif name == '--request':
+      request["method"] = value
+    elif name == '--header':
+      header, colon, header_value = value.partition(':')
+      header_value = header_value.strip()
+      if not colon or not header_value or header.strip().lower() in [h.lower() for h in request["headers"]]:
+        return None
+      request["headers"][header.strip()] = header_value
+    elif name in CURL_DATA_OPTIONS or name == '--json':
+      if value.startswith('@') and name != '--data-raw':
+        return None
+      if request["data"] is None:
+        request["data"] = value
+      else:
+        request["data"] += value if name == '--json' else '&' + value
+      if name == '--json':
+        default_headers["Content-Type"] = "application/json"
+        default_headers["Accept"] = "application/json"
+      else:
+        default_headers.setdefault("Content-Type", "application/x-www-form-urlencoded")
+    elif name == '--cookie':
+      if '=' not in value:
+        return None # cookie jar files are not supported
+      default_headers["Cookie"] = value
+    elif name == '--user':
+      if ':' not in value:
+        return None # curl prompts for the password
+      default_headers["Authorization"] = "Basic " + base64.b64encode(value.encode('utf-8')).decode('utf-8')
+    elif name == '--user-agent':
+      default_headers["User-Agent"] = value
+    elif name == '--referer':
+      default_headers["Referer"] = value
+    elif name == '--max-time':
+      if not re.fullmatch(r'\d+(\.\d*)?|\.\d+', value.strip()):
+        raise ValueError(f"--max-time expects a number of seconds, got {excerpt(json.dumps(value))}")
+      request["timeout"] = float(value)
+    elif name == '--location':
+      # requests drops -b cookies and keeps cookies the server set when following a redirect (and may switch -X to GET), curl doesn't
+      return None
+    elif name == '--insecure':
+      request["verify"] = False
+    elif name == '--globoff':
+      globoff = True
+    elif name == '--compressed':
+      request["compressed"] = True
+      default_headers["Accept-Encoding"] = "deflate, gzip"
+    elif name not in ['--silent', '--show-error']:
+      return None
+
+  if request["url"] is None or (not globoff and re.search(r'[\[\]{}]', request["url"])):
+    return None
+  if "://" not in request["url"]:
+    request["url"] = "http://" + request["url"]
+  if not request["url"].startswith(("http://", "https://")):
+    return None
+  if request["method"] is None:
+    request["method"] = "POST" if request["data"] is not None else "GET"
+  if request["data"] is not None:
+    request["data"] = request["data"].encode('utf-8')
+  for header, header_value in default_headers.items():
+    if header.lower() not in [h.lower() for h in request["headers"]]:
+      request["headers"][header] = header_value
+  return request
+
+
+http_session = None
+http_session_lock = threading.Lock()
+
+def make_http_session(pool_size):
+  session = requests.Session()
+  session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+  session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+  # Match the headers curl sends by default instead of the ones from requests
+  session.headers.clear()
+  session.headers.update({"User-Agent": "curl", "Accept": "*/*"})
+  # Every curl command starts without cookies, so cookies set by one test must never be sent by the next one (only -b is sent)
+  session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+  return session
+
+
+def get_http_session():
+  global http_session
+  with http_session_lock:
+    if http_session is None:
+      http_session = make_http_session(max(10, config.get("testConcurrency", 1)))
+  return http_session
+
+
+def run_pooled_curl_command(request, timeout, limit):
+  session = get_http_session()
+  if request["timeout"] is not None:
+    timeout = request["timeout"] if timeout is None else min(timeout, request["timeout"])
+  deadline = None if timeout is None else time.monotonic() + timeout
+  body = ResponseBody(limit)
+  try:
+    response = session.request(request["method"], request["url"], headers=request["headers"], data=request["data"], allow_redirects=request["allow_redirects"], verify=request["verify"], timeout=timeout, stream=True)
+    with response:
+      # curl only decodes the body if --compressed is given
+      for chunk in response.raw.stream(65536, decode_content=request["compressed"]):
+        body.feed(chunk)
+        if deadline is not None and time.monotonic() > deadline:
+          return 28, f"curl: (28) Operation timed out after {timeout:.1f} seconds\n", 0, ResponseBody(limit)
+  except (requests.exceptions.Timeout, urllib3.exceptions.TimeoutError) as e:
+    return 28, f"curl: (28) Operation timed out: {e}\n", 0, ResponseBody(limit)
+  except requests.exceptions.ConnectionError as e:
+    return 7, f"curl: (7) Failed to connect: {e}\n", 0, ResponseBody(limit)
+  except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+    return 56, f"curl: (56) Failure when receiving data: {e}\n", 0, ResponseBody(limit)
+  return 0, "", response.status_code, body
+
+
+def run_curl_subprocess(args, timeout, limit):
+  body = ResponseBody(limit, holdback=4) # "\n%{http_code}" is written after the body
+  process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  stderr = bytearray()
+  def read_stderr():
+    for chunk in iter(lambda: process.stderr.read1(65536), b""):
+      stderr.extend(chunk[:MAX_STDERR_BYTES - len(stderr)])
+  stderr_thread = threading.Thread(target=read_stderr, daemon=True)
+  stderr_thread.start()
+  timed_out = threading.Event()
+  def kill():
+    timed_out.set()
+    process.kill()
+  timer = threading.Timer(timeout, kill) if timeout is not None else None
+  if timer is not None:
+    timer.start()
+  try:
+    for chunk in iter(lambda: process.stdout.read1(65536), b""):
+      body.feed(chunk)
+    process.wait()
+    stderr_thread.join()
+  finally:
+    if timer is not None:
+      timer.cancel()
+  if timed_out.is_set():
+    return 28, f"curl: (28) The test did not finish within {timeout:.1f} seconds\n", 0, ResponseBody(limit)
+  try:
+    response_code = int(body.pending.strip())
+  except ValueError:
+    response_code = 0
+  return process.returncode, stderr.decode('utf-8', errors='replace'), response_code, body
 
-def run_curl_command(curl_command):
-  modified_curl_command = curl_command + ' -w "\\n%{http_code}"'
-  args = shlex.split(modified_curl_command)
 
-  result = subprocess.run(args, capture_output=True, text=True)
+def run_curl_command(plan, port=None, deadline=None):
+  timeout = bounded_timeout(config.get("testTimeout", 60), deadline=deadline)
+  limit = config.get("maxResponseBytes", DEFAULT_MAX_RESPONSE_BYTES)
+  if config.get("curlEngine", "subprocess") == "pooled" and plan.request is not None:
+    request = plan.request if port is None else dict(plan.request, url=rewrite_port(plan.request["url"], port))
+    return run_pooled_curl_command(request, timeout, limit)
 
-  output_parts = result.stdout.strip().split('\n')
-  response_body = '\n'.join(output_parts[:-1])
-  response_code = int(output_parts[-1])
+  args = plan.args if port is None else [rewrite_port(arg, port) for arg in plan.args]
+  return run_curl_subprocess(args + ["-w", "\\n%{http_code}"], timeout, limit)
 
-  return result.returncode, result.stdout, result.stderr, response_code, response_body
 
+def rewrite_port(command, port):
+  # Points requests at the port a server was started on instead of the one written in the tests
+  target_port = 3000
+  for key in ["parallelPhases", "batch"]:
+    if config.get(key) is not None and "port" in config[key]:
+      target_port = config[key]["port"]
+  return re.sub(rf'\b(localhost|127\.0\.0\.1):{target_port}\b', rf'\g<1>:{port}', command)
 
-def run_curl_test(test):
-  curl_command = test['test']['command']
-  response_type = test['test']['response-type']
-  expected_status = test['test']['response']['status']
 
-  returncode, _, stderr, response_code, response_body = run_curl_command(curl_command)
+def run_curl_test(plan, port=None, deadline=None):
+  returncode, stderr, response_code, response_body = run_curl_command(plan, port, deadline)
 
   if returncode != 0:
-    return {"success": False, "reason": f"Error executing test '{test['name']}':\n{stderr}"}
+    # Timeouts, refused connections and the like say more about the server at that moment than about the test
+    return {"success": False, "reason": f"Error executing test '{plan.name}':\n{stderr}", "transient": True}
 
-  if response_code != expected_status:
-    return {"success": False, "reason": f"Test '{test['name']}' failed: Expected status {expected_status}, got {response_code}"}
+  if response_code != plan.status:
+    return {"success": False, "reason": f"Test '{plan.name}' failed: Expected status {plan.status}, got {response_code}"}
   
-  if response_type == "json":
+  if plan.response_type == "json":
+    if response_body.truncated:
+      return {"success": False, "reason": f"Test '{plan.name}' failed: Response body is too large to compare as JSON ({response_body.size} bytes, the limit is {response_body.limit} bytes)"}
     try:
-      response_json = json.loads(response_body)
+      response_json = json.loads(response_body.text)
     except json.JSONDecodeError:
-      return {"success": False, "reason": f"Test '{test['name']}' failed: Response body is not valid JSON"}
-    expected_json = test['test']['response']['json']
-    any_order = test['test']['any-order'] if 'any-order' in test['test'] else False
-    if not compare_json(response_json, expected_json, any_order):
-      return {"success": False, "reason": f"Test '{test['name']}' failed: Expected body {expected_json}, got {response_json}"}
-  elif response_type == "text":
-    expected_body = test['test']['response']['body']
-    if response_body != expected_body:
-      return {"success": False, "reason": f"Test '{test['name']}' failed: Expected body {expected_body}, got {response_body}"}
-
-  return {"success": True, "reason": f"Test '{test['name']}' Passed"}
-
-
-def run_junit_tests(test, setup):
-  base = "/autograder/source" if setup else "/autograder/submission"
-  raw_tests = base64.b64decode(test["content"])
-  test_file_path = os.path.join(base, config["jUnitTestLocation"], f"{test['name']}.java")
-  pom_file_path = os.path.join(base, config["pomPath"])
-  # fix path
-  report_path = os.path.join(base, "sample-submission", "target/surefire-reports", f"TEST-nets2120.{test['name']}.xml")
-  with open(test_file_path, 'wb') as file:
-    file.write(raw_tests)
-  subprocess.run(["mvn", "test", "-f", pom_file_path])
+      return {"success": False, "reason": f"Test '{plan.name}' failed: Response body is not valid JSON"}
+    if plan.any_order:
+      matches = json_digest(response_json, True) == plan.expected_digest
+    else:
+      matches = response_json == plan.expected_json
+    if not matches:
+      difference = find_json_difference(response_json, plan.expected_json, plan.any_order) or f"expected {excerpt(json.dumps(plan.expected_json))}, got {excerpt(json.dumps(response_json))}"
+      return {"success": False, "reason": f"Test '{plan.name}' failed: Body differs from expected at {difference}"}
+  elif plan.response_type == "text":
+    if not response_body.matches(plan.expected_body):
+      return {"success": False, "reason": f"Test '{plan.name}' failed: Expected body {excerpt(plan.expected_body)}, got {response_body.excerpt()}"}
+
+  return {"success": True, "reason": f"Test '{plan.name}' Passed"}
+
+LOAD_BUDGETS = {"max-p50-ms": "p50_ms", "max-p95-ms": "p95_ms", "max-p99-ms": "p99_ms", "min-rps": "rps", "max-error-rate": "error_rate"}
+
+def get_percentile(sorted_values, percentile):
+  # Nearest-rank percentile
+  return sorted_values[max(0, math.ceil(percentile / 100 * len(sorted_values)) - 1)]
+
+
+def run_load_test(plan, port=None, phase_deadline=None):
+  # Sends the request request_count times from concurrency threads over one keep-alive pool, and checks the latencies and throughput against the test's budgets
+  request = plan.request if port is None else dict(plan.request, url=rewrite_port(plan.request["url"], port))
+  timeout = bounded_timeout(config.get("testTimeout", 60), deadline=phase_deadline)
+  deadline = time.monotonic() + timeout
+  session = make_http_session(plan.concurrency)
+  remaining = iter(range(plan.request_count))
+  remaining_lock = threading.Lock()
+  latencies = []
+  failures = []
+
+  def send_requests():
+    while time.monotonic() < deadline and not budget_exceeded.is_set():
+      with remaining_lock:
+        if next(remaining, None) is None:
+          return
+      start = time.perf_counter()
+      try:
+        response = session.request(request["method"], request["url"], headers=request["headers"], data=request["data"], allow_redirects=request["allow_redirects"], verify=request["verify"], timeout=max(deadline - time.monotonic(), 0.001), stream=True)
+        with response:
+          for _ in response.raw.stream(65536, decode_content=False):
+            pass
+        if response.status_code != plan.status:
+          failures.append(f"expected status {plan.status}, got {response.status_code}")
+      except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+        failures.append(str(e))
+      latencies.append((time.perf_counter() - start) * 1000)
+
+  start = time.perf_counter()
+  with session, concurrent.futures.ThreadPoolExecutor(max_workers=plan.concurrency) as executor:
+    for future in [executor.submit(send_requests) for _ in range(plan.concurrency)]:
+      future.result()
+  elapsed = time.perf_counter() - start
+
+  if len(latencies) < plan.request_count:
+    return {"success": False, "reason": f"Test '{plan.name}' failed: Only {len(latencies)} of {plan.request_count} requests finished within {timeout:.0f} seconds", "transient": True}
+  latencies.sort()
+  stats = {"p50_ms": get_percentile(latencies, 50), "p95_ms": get_percentile(latencies, 95), "p99_ms": get_percentile(latencies, 99), "rps": len(latencies) / elapsed, "error_rate": len(failures) / len(latencies)}
+  summary = f"{plan.request_count} requests at concurrency {plan.concurrency}: p50 {stats['p50_ms']:.1f} ms, p95 {stats['p95_ms']:.1f} ms, p99 {stats['p99_ms']:.1f} ms, {stats['rps']:.1f} requests/second, {len(failures)} failed"
+
+  problems = []
+  for budget, value in plan.budgets.items():
+    stat = LOAD_BUDGETS[budget]
+    if (budget.startswith("min-") and stats[stat] < value) or (budget.startswith("max-") and stats[stat] > value):
+      problems.append(f"{stat} was {stats[stat]:.3g} (the test's {budget} is {value})")
+  if "max-error-rate" not in plan.budgets and len(failures) > 0:
+    problems.append(f"{len(failures)} requests failed (e.g. {excerpt(failures[0])})")
+  # Measurements depend on the machine and what else is running, so they're never reused from the cache
+  if len(problems) > 0:
+    return {"success": False, "reason": f"Test '{plan.name}' failed: " + "; ".join(problems) + f"\n{summary}", "transient": True, "load": stats}
+  return {"success": True, "reason": f"Test '{plan.name}' Passed\n{summary}", "transient": True, "load": stats}
+
+
+def get_maven_command():
+  # mvnd keeps a warm daemon between the sample and student passes instead of starting a new JVM each time
+  if config.get("useMavenDaemon", False) and shutil.which("mvnd"):
+    command = ["mvnd"]
+  else:
+    command = ["mvn"]
+  if config.get("mavenOffline", False):
+    command.append("-o")
+  return command
 
-  if not os.path.exists(report_path):
-    return [{"name": test['name'], "success": False, "reason": "Test report not found"}]
 
-  tree = ET.parse(report_path)
-  root = tree.getroot()
-  test_results = []
+def get_junit_class_name(source, test_name):
+  match = re.search(r'^\s*package\s+([\w.]+)\s*;', source, re.M)
+  return f"{match.group(1)}.{test_name}" if match else test_name
 
-  for testcase in root.iter('testcase'):
-    test_name = testcase.get('name')
-    classname = testcase.get('classname')
+
+def parse_surefire_report(report_path):
+  test_results = []
+  for _, element in ET.iterparse(report_path):
+    if element.tag != 'testcase':
+      continue
+    test_name = element.get('name')
+    classname = element.get('classname')
     full_test_name = f"{classname}.{test_name}"
-    error = testcase.find('error')
-    failure = testcase.find('failure')
+    error = element.find('error')
+    failure = element.find('failure')
     if error is not None or failure is not None:
       reason = error.text if error is not None else failure.text
       test_results.append({"name": full_test_name, "success": False, "reason": f"Test '{full_test_name}' Failed: {reason}"})
     else:
       test_results.append({"name": full_test_name, "success": True, "reason": f"Test '{full_test_name}' Passed"})
-
+    element.clear()
   return test_results
 
 
-def run_test(test, setup):
+@traced
+def run_junit_tests(plans, setup, deadline=None):
+  # Writes out every junit test and runs them all in one maven invocation, returns the results of each test by name
+  base = SOURCE_DIR if setup else SUBMISSION_DIR
+  pom_file_path = os.path.join(base, config["pomPath"])
+  report_dir = os.path.join(os.path.dirname(pom_file_path), "target", "surefire-reports")
+  results = {}
+  report_paths = {}
+  for plan in plans:
+    try:
+      test_file_path = os.path.join(base, config["jUnitTestLocation"], f"{plan.name}.java")
+      with open(test_file_path, 'wb') as file:
+        file.write(plan.source)
+    except OSError as e:
+      results[plan.name] = [{"name": plan.name, "success": False, "reason": f"Error running test '{plan.name}'. The test could not be written out: {e}", "transient": True}]
+      continue
+    report_path = os.path.join(report_dir, f"TEST-{plan.class_name}.xml")
+    if os.path.exists(report_path):
+      os.remove(report_path) # don't pick up a stale report if this class fails to compile
+    report_paths[plan.name] = report_path
+
+  if len(report_paths) > 0:
+    timeout = bounded_timeout(config.get("phaseTimeout", 600), deadline=deadline)
+    process = subprocess.Popen(get_maven_command() + ["test", "-f", pom_file_path, "-Dtest=" + ",".join(report_paths), "-Dsurefire.failIfNoSpecifiedTests=false", "-Dmaven.test.failure.ignore=true"], start_new_session=True)
+    active_process_groups.add(process.pid)
+    try:
+      process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+      os.killpg(process.pid, signal.SIGKILL) # also stops the JVMs surefire forks
+      process.wait()
+      for name in report_paths:
+        results[name] = [{"name": name, "success": False, "reason": f"Maven did not finish running the JUnit tests within {timeout:.0f} seconds", "transient": True}]
+      return results
+    finally:
+      active_process_groups.discard(process.pid)
+
+  for name, report_path in report_paths.items():
+    if not os.path.exists(report_path):
+      # e.g. maven couldn't resolve a dependency or the test didn't compile, which isn't cached in case it was the environment
+      results[name] = [{"name": name, "success": False, "reason": "Test report not found", "transient": True}]
+      continue
+    try:
+      results[name] = parse_surefire_report(report_path)
+    except ET.ParseError as e:
+      results[name] = [{"name": name, "success": False, "reason": f"Test report could not be parsed: {e}", "transient": True}]
+  return results
+
+
+def run_test(plan, setup, junit_results, port=None, fail_fast=None, deadline=None):
+  if budget_exceeded.is_set():
+    return get_skipped_result(plan)
+  if deadline is not None and time.monotonic() >= deadline:
+    return get_phase_skipped_result(plan)
+  if fail_fast is not None and fail_fast.should_skip(plan):
+    return fail_fast.get_skipped_result(plan)
+  with timed(plan.label, "test", type=plan.type):
+    test_result = run_test_untimed(plan, setup, junit_results, port, deadline)
+  if fail_fast is not None:
+    fail_fast.record(plan, test_result)
+  return test_result
+
+
+def run_test_untimed(plan, setup, junit_results, port, deadline=None):
+  if plan.errors:
+    return {"success": False, "reason": f"Test '{plan.label}' is not formatted correctly, so it was not run:\n" + "\n".join("$" + error for error in plan.errors)}
   try:
-    if test["type"] == "curl":
-      return run_curl_test(test)
-    elif test["type"] == "junit":
-      return run_junit_tests(test, setup)
+    if plan.type == "curl":
+      return run_curl_test(plan, port, deadline)
+    elif plan.type == "load":
+      return run_load_test(plan, port, deadline)
     else:
-      return {"success": False, "reason": f"Unknown test type '{test['type']}'"}
+      return junit_results[plan.name]
   except Exception as e:
-    return {"success": False, "reason": f"Error running test '{test['name']}'. It is likely the test is formatted incorrectly: {e}"}
-
-
-def run_tests(tests, setup=False):
-  results = {"passed": 0, "failed": 0, "results": []}
-
-  for test in tests:
-    test_result = run_test(test, setup)
-    if test["type"] == "curl":
-      results["results"].append({
-        "name": test["name"],
-        "result": test_result,
-        "test": test
-      })
-      if test_result["success"]:
-        results["passed"] += 1
+    return {"success": False, "reason": f"Error running test '{plan.name}': {e}"}
+
+
+def get_test_dependencies(plans, load_barriers=True):
+  # Tests wait for any earlier tests named in their "depends-on" field, and stateful tests wait for all earlier tests and block all later ones.
+  # Load tests do the same (unless load_barriers is false), so other tests don't skew their measurements
+  indices = {}
+  dependencies = []
+  last_barrier = None
+  for i, plan in enumerate(plans):
+    deps = set()
+    for name in plan.depends_on:
+      if name in indices:
+        deps.add(indices[name])
+    if plan.stateful or (load_barriers and plan.type == "load"):
+      deps.update(range(0 if last_barrier is None else last_barrier, i))
+      last_barrier = i
+    elif last_barrier is not None:
+      deps.add(last_barrier)
+    dependencies.append(sorted(deps))
+    if plan.name is not None:
+      indices.setdefault(plan.name, i)
+  return dependencies
+
+
+def run_test_after(plan, setup, junit_results, port, fail_fast, deadline, dependencies):
+  concurrent.futures.wait(dependencies)
+  return run_test(plan, setup, junit_results, port, fail_fast, deadline)
+
+
+def run_tests_concurrently(plans, setup, junit_results, concurrency, port, fail_fast=None, deadline=None):
+  # Yields the index and result of each test as it finishes.
+  # Dependencies only point to earlier tests and tasks are started in order, so a waiting test can't block the ones it waits on
+  futures = []
+  with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+    for plan, deps in zip(plans, get_test_dependencies(plans)):
+      futures.append(executor.submit(run_test_after, plan, setup, junit_results, port, fail_fast, deadline, [futures[d] for d in deps]))
+    indices = {future: i for i, future in enumerate(futures)}
+    for future in concurrent.futures.as_completed(futures):
+      yield indices[future], future.result()
+
+
+def is_default_test(plan):
+  return plan.test is not None and plan.test.get("isDefault", False)
+
+
+def get_test_order(plans, history):
+  # Default tests first, then the tests that fail most often or whose outcome changed most often recently (if there is any
+  # history, otherwise the others keep their order).
+  # A test still never runs before the tests it depends on, so stateful tests keep their place between the others
+  dependencies = get_test_dependencies(plans)
+  dependents = [[] for _ in plans]
+  waiting = [len(deps) for deps in dependencies]
+  for i, deps in enumerate(dependencies):
+    for dep in deps:
+      dependents[dep].append(i)
+
+  def get_priority(i):
+    stats = history.get(plans[i].name) or {}
+    return (not is_default_test(plans[i]), -(stats.get("failureRate", 0) + stats.get("flakiness", 0)), i)
+
+  ready = [get_priority(i) for i in range(len(plans)) if waiting[i] == 0]
+  heapq.heapify(ready)
+  order = []
+  while ready:
+    i = heapq.heappop(ready)[-1]
+    order.append(i)
+    for dependent in dependents[i]:
+      waiting[dependent] -= 1
+      if waiting[dependent] == 0:
+        heapq.heappush(ready, get_priority(dependent))
+  return order
+
+
+class FailFast:
+  # Stops running other students' tests once enough of them failed, default tests are always run since they are graded
+  __slots__ = ("limit", "failures", "lock")
+
+  def __init__(self, limit):
+    self.limit = limit
+    self.failures = 0
+    self.lock = threading.Lock()
+
+  def should_skip(self, plan):
+    return plan.type != "junit" and not is_default_test(plan) and self.failures >= self.limit # JUnit tests already ran together
+
+  def record(self, plan, test_result):
+    if is_default_test(plan):
+      return
+    failed = any(not result["success"] for result in (test_result if isinstance(test_result, list) else [test_result]))
+    if failed:
+      with self.lock:
+        self.failures += 1
+
+  def get_skipped_result(self, plan):
+    return {"success": False, "reason": f"Test '{plan.label}' was skipped because {self.limit} other tests already failed, and fail-fast mode stops there before the deadline. All tests are run on submissions at or after the deadline.", "transient": True, "skipped": True}
+
+
+def get_fail_fast():
+  # Only before the deadline, so submissions (and regrades) at or after it always run every test
+  if config.get("failFast") is None:
+    return None
+  due_date = datetime.strptime(metadata["assignment"]["due_date"], "%Y-%m-%dT%H:%M:%S.%f%z")
+  if datetime.now(due_date.tzinfo) >= due_date:
+    return None
+  return FailFast(config["failFast"])
+
+
+DEFAULT_CACHE_IGNORE = ['node_modules', 'target', '.git', '__pycache__', 'package-lock.json']
+directory_digests = {}
+
+def get_directory_digest(path, extra_ignored=()):
+  # Digest of every file in the directory, skipping dependencies and build outputs that pre-test.sh generates
+  if path in directory_digests:
+    return directory_digests[path]
+  ignored = set(config.get("cacheIgnore", DEFAULT_CACHE_IGNORE)) | set(extra_ignored)
+  digest = hashlib.sha256()
+  for root, dirs, files in os.walk(path):
+    dirs[:] = sorted(d for d in dirs if d not in ignored)
+    for name in sorted(files):
+      if name in ignored:
+        continue
+      file_path = os.path.join(root, name)
+      file_digest = hashlib.sha256()
+      with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+          file_digest.update(chunk)
+      digest.update(os.path.relpath(file_path, path).encode('utf-8') + b"\0" + file_digest.digest())
+  directory_digests[path] = digest.hexdigest()
+  return directory_digests[path]
+
+
+def get_test_digest(test):
+  fields = {key: test.get(key) for key in ["name", "type", "test", "content"]}
+  return hashlib.sha256(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def get_grader_digest():
+  with open(__file__, 'rb') as file:
+    return hashlib.sha256(file.read()).hexdigest()
+
+
+def get_cache_dir(kind, submission_digest):
+  digest = hashlib.sha256(submission_digest.encode('utf-8'))
+  digest.update(get_grader_digest().encode('utf-8')) # results also depend on how the grader runs the tests
+  digest.update(json.dumps(config, sort_keys=True).encode('utf-8'))
+  return os.path.join(config.get("cacheDir", f"{SOURCE_DIR}/test-grader/cache"), kind, digest.hexdigest())
+
+
+def get_sample_cache_dir():
+  if not config.get("cacheSampleResults", False):
+    return None
+  return get_cache_dir("sample", get_directory_digest(SAMPLE_DIR))
+
+
+def get_student_cache_dir():
+  if not config.get("incrementalGrading", False):
+    return None
+  # The student's own tests.json doesn't change how their code behaves
+  return get_cache_dir("student", get_directory_digest(SUBMISSION_DIR, extra_ignored=["tests.json"]))
+
+
+def load_cached_results(plans, cache_dir):
+  cached_results = {}
+  if cache_dir is None:
+    return cached_results
+  for i, plan in enumerate(plans):
+    if plan.digest is None:
+      continue
+    try:
+      with open(os.path.join(cache_dir, plan.digest + ".json"), 'r') as file:
+        cached_results[i] = json.load(file)
+    except (OSError, ValueError):
+      pass
+  return cached_results
+
+
+def store_cached_results(plans, test_results, cache_dir):
+  # Returns the digests of the results that were stored
+  stored = []
+  try:
+    os.makedirs(cache_dir, exist_ok=True)
+    for plan, test_result in zip(plans, test_results):
+      if plan.digest is None or any(result.get("transient", False) for result in (test_result if isinstance(test_result, list) else [test_result])):
+        continue # timeouts and skipped tests aren't a real outcome of the test
+      cache_path = os.path.join(cache_dir, plan.digest + ".json")
+      with open(f"{cache_path}.{os.getpid()}.tmp", 'w') as file:
+        file.write(json.dumps(test_result)) # json.dump doesn't use the C encoder
+      os.replace(f"{cache_path}.{os.getpid()}.tmp", cache_path)
+      stored.append(plan.digest)
+  except OSError as e:
+    print(f"Could not write to the results cache {cache_dir}: {e}")
+  return stored
+
+
+def remove_cached_results(digests, cache_dir):
+  for digest in digests:
+    try:
+      os.remove(os.path.join(cache_dir, digest + ".json"))
+    except OSError:
+      pass
+
+
+class TestPlan:
+  # A test after it has been validated and pre-parsed, so running it doesn't have to dig through (or re-parse) the raw test
+  __slots__ = ("test", "digest", "errors", "name", "type", "stateful", "depends_on", "args", "request", "response_type", "status", "any_order", "expected_digest", "source", "class_name", "request_count", "concurrency", "budgets")
+
+  def __init__(self, test):
+    self.test = test # the raw test, which is what gets uploaded and reported
+    self.digest = None
+    self.errors = [] # problems with the test, each starting with the path of the field (relative to the test)
+    self.name = None
+    self.type = None
+    self.stateful = False
+    self.depends_on = []
+    self.args = None # tokenised curl command
+    self.request = None # the curl command translated for the pooled engine, if it can be
+    self.response_type = None
+    self.status = None
+    self.any_order = False
+    self.expected_digest = None
+    self.source = None # decoded JUnit source
+    self.class_name = None
+    self.request_count = None # load tests
+    self.concurrency = None
+    self.budgets = {}
+
+  @property
+  def label(self):
+    return self.name if self.name is not None else "(unnamed test)"
+
+  # The expected bodies are read from the raw test rather than copied, so they aren't stored twice
+  @property
+  def expected_json(self):
+    return self.test["test"]["response"]["json"]
+
+  @property
+  def expected_body(self):
+    return self.test["test"]["response"]["body"]
+
+  def with_test(self, test):
+    # The same plan for another copy of the test, e.g. one returned by the testit server with extra fields like createdAt
+    plan = copy.copy(self)
+    plan.test = test
+    return plan
+
+  def to_json(self):
+    # The plan without its test as plain json, with the bytes fields in base64
+    data = {field: getattr(self, field) for field in self.__slots__ if field != "test"}
+    for field in ["expected_digest", "source"]:
+      if data[field] is not None:
+        data[field] = base64.b64encode(data[field]).decode('ascii')
+    if self.request is not None and self.request["data"] is not None:
+      data["request"] = dict(self.request, data=base64.b64encode(self.request["data"]).decode('ascii'))
+    return data
+
+  @classmethod
+  def from_json(cls, data):
+    plan = cls(None)
+    for field in cls.__slots__:
+      if field != "test":
+        setattr(plan, field, data[field])
+    for field in ["expected_digest", "source"]:
+      if getattr(plan, field) is not None:
+        setattr(plan, field, base64.b64decode(getattr(plan, field), validate=True))
+    if plan.request is not None and plan.request["data"] is not None:
+      plan.request = dict(plan.request, data=base64.b64decode(plan.request["data"], validate=True))
+    return plan
+
+
+JSON_TYPE_NAMES = {dict: "an object", list: "a list", str: "a string", int: "an integer", float: "a number", bool: "a boolean", type(None): "null"}
+
+def describe_json_type(value):
+  return JSON_TYPE_NAMES.get(type(value), type(value).__name__)
+
+
+def get_field(container, key, types, path, errors, required=True):
+  # Returns container[key] if it has one of the given types, otherwise records an error. Optional fields may also be null
+  field_path = get_json_path(path, key)
+  value = container.get(key)
+  if key not in container or (value is None and not required):
+    if required:
+      errors.append(f"{field_path}: missing required field")
+    return None
+  if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+    errors.append(f"{field_path}: expected {' or '.join(JSON_TYPE_NAMES[t] for t in types)}, got {describe_json_type(value)}")
+    return None
+  return value
+
+
+def compile_command(plan, body, errors):
+  # Returns whether the test has a valid curl command
+  command = get_field(body, "command", (str,), ".test", errors)
+  if command is None:
+    return False
+  try:
+    plan.args = shlex.split(command)
+  except ValueError as e:
+    errors.append(f".test.command: could not be parsed: {e}")
+    return False
+  if len(plan.args) == 0 or os.path.basename(plan.args[0]) != "curl":
+    errors.append(".test.command: must be a curl command")
+    return False
+  try:
+    plan.request = parse_curl_args(plan.args)
+  except ValueError as e:
+    errors.append(f".test.command: {e}")
+    return False
+  return True
+
+
+def compile_curl_test(plan, test, errors):
+  body = get_field(test, "test", (dict,), "", errors)
+  if body is None:
+    return
+  compile_command(plan, body, errors)
+
+  plan.response_type = get_field(body, "response-type", (str,), ".test", errors)
+  if plan.response_type not in [None, "json", "text"]:
+    errors.append(f'.test.response-type: expected "json" or "text", got {excerpt(json.dumps(plan.response_type))}')
+  plan.any_order = get_field(body, "any-order", (bool,), ".test", errors, required=False) or False
+  response = get_field(body, "response", (dict,), ".test", errors)
+  if response is None:
+    return
+  plan.status = get_field(response, "status", (int,), ".test.response", errors)
+  if plan.response_type == "json":
+    if "json" not in response:
+      errors.append(".test.response.json: missing required field")
+    elif plan.any_order:
+      plan.expected_digest = json_digest(response["json"], True)
+  elif plan.response_type == "text":
+    get_field(response, "body", (str,), ".test.response", errors)
+
+
+def compile_load_test(plan, test, errors):
+  body = get_field(test, "test", (dict,), "", errors)
+  if body is None:
+    return
+  if compile_command(plan, body, errors) and plan.request is None:
+    errors.append(".test.command: load tests can only use the curl flags supported by the pooled engine (e.g. -X, -H, -d, --json, -b, -u)")
+
+  max_requests = config.get("maxLoadRequests", 1000)
+  plan.request_count = get_field(body, "requests", (int,), ".test", errors)
+  if plan.request_count is not None and not 1 <= plan.request_count <= max_requests:
+    errors.append(f".test.requests: must be between 1 and {max_requests}")
+  max_concurrency = config.get("maxLoadConcurrency", 32)
+  plan.concurrency = get_field(body, "concurrency", (int,), ".test", errors, required=False)
+  if plan.concurrency is None:
+    plan.concurrency = 1
+  elif not 1 <= plan.concurrency <= max_concurrency:
+    errors.append(f".test.concurrency: must be between 1 and {max_concurrency}")
+  for budget in LOAD_BUDGETS:
+    value = get_field(body, budget, (int, float), ".test", errors, required=False)
+    if value is not None:
+      plan.budgets[budget] = value
+
+  response = get_field(body, "response", (dict,), ".test", errors)
+  if response is not None:
+    plan.status = get_field(response, "status", (int,), ".test.response", errors)
+
+
+def compile_junit_test(plan, test, errors):
+  content = get_field(test, "content", (str,), "", errors)
+  if content is None:
+    return
+  try:
+    plan.source = base64.b64decode(content)
+  except (binascii.Error, ValueError) as e:
+    errors.append(f".content: not valid base64: {e}")
+    return
+  plan.class_name = get_junit_class_name(plan.source.decode('utf-8', errors='replace'), plan.label)
+
+
+def compile_test(test):
+  # Checks every field of the test, recording all of the problems rather than stopping at the first one
+  plan = TestPlan(test if isinstance(test, dict) else {})
+  errors = plan.errors
+  if not isinstance(test, dict):
+    errors.append(f": expected a test object, got {describe_json_type(test)}")
+    return plan
+  plan.digest = get_test_digest(test)
+  plan.name = get_field(test, "name", (str,), "", errors)
+  if plan.name is not None and plan.name.strip() == "":
+    errors.append(".name: must not be empty")
+  plan.type = get_field(test, "type", (str,), "", errors)
+  get_field(test, "description", (str,), "", errors, required=False)
+  get_field(test, "public", (bool,), "", errors, required=False)
+  plan.stateful = get_field(test, "stateful", (bool,), "", errors, required=False) or False
+  depends_on = get_field(test, "depends-on", (str, list), "", errors, required=False) or []
+  for i, name in enumerate([depends_on] if isinstance(depends_on, str) else depends_on):
+    if isinstance(name, str):
+      plan.depends_on.append(name)
+    else:
+      errors.append(f".depends-on[{i}]: expected a string, got {describe_json_type(name)}")
+
+  if plan.type == "curl":
+    compile_curl_test(plan, test, errors)
+  elif plan.type == "load":
+    compile_load_test(plan, test, errors)
+  elif plan.type == "junit":
+    compile_junit_test(plan, test, errors)
+  elif plan.type is not None:
+    errors.append(f'.type: expected "curl", "load" or "junit", got {excerpt(json.dumps(plan.type))}')
+  return plan
+
+
+PLAN_FIELDS = ["name", "type", "test", "content", "stateful", "depends-on", "description", "public"] # the fields a plan depends on
+plan_store = None
+plan_store_changed = False
+
+def get_plan_store_path():
+  # Plans can only be reused by the same version of the grader, and checking them depends on the config
+  digest = hashlib.sha256(get_grader_digest().encode('utf-8'))
+  digest.update(json.dumps(config, sort_keys=True).encode('utf-8'))
+  return os.path.join(config.get("cacheDir", f"{SOURCE_DIR}/test-grader/cache"), "plans", digest.hexdigest() + ".json")
+
+
+def load_plan_store():
+  global plan_store
+  if plan_store is None:
+    plan_store = {}
+    if config.get("cacheTestPlans", True):
+      try:
+        # Stored as json rather than pickled, since cacheDir may be writable by the student servers run in --batch
+        with open(get_plan_store_path(), 'r') as file:
+          plan_store = {key: TestPlan.from_json(data) for key, data in json.load(file).items()}
+      except (OSError, ValueError, KeyError, TypeError, AttributeError, binascii.Error):
+        plan_store = {}
+  return plan_store
+
+
+def save_plan_store():
+  global plan_store_changed
+  if not plan_store_changed or not config.get("cacheTestPlans", True):
+    return
+  path = get_plan_store_path()
+  try:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.{os.getpid()}.tmp", 'w') as file:
+      file.write(json.dumps({key: plan.to_json() for key, plan in plan_store.items()}))
+    os.replace(f"{path}.{os.getpid()}.tmp", path)
+    plan_store_changed = False
+  except OSError as e:
+    print(f"Could not write the test plan cache {path}: {e}")
+
+
+def is_stored_plan_valid(plan, test):
+  # cacheDir may be writable by the student servers run in --batch, so a stored plan is only used if the command and JUnit source it
+  # would run (and the files it would write) are exactly the ones in the test. Checking these is cheap compared to the rest of a plan
+  if plan.name != test.get("name") or plan.type != test.get("type"):
+    return False
+  if plan.args is not None or plan.request is not None:
+    body = test.get("test")
+    command = body.get("command") if isinstance(body, dict) else None
+    if not isinstance(command, str):
+      return False
+    try:
+      args = shlex.split(command)
+      request = parse_curl_args(args)
+    except ValueError:
+      return False
+    if len(args) == 0 or os.path.basename(args[0]) != "curl" or plan.args != args or plan.request != request:
+      return False
+  if plan.source is not None or plan.class_name is not None:
+    content = test.get("content")
+    try:
+      source = base64.b64decode(content) if isinstance(content, str) else None
+    except (binascii.Error, ValueError):
+      return False
+    if source is None or plan.source != source or plan.class_name != get_junit_class_name(source.decode('utf-8', errors='replace'), plan.label):
+      return False
+  return True
+
+
+@traced
+def compile_tests(tests):
+  # Returns a plan for every test and all of the problems found in them, with paths like $[2].test.response.status
+  global plan_store_changed
+  if not isinstance(tests, list):
+    return [], [f"$: expected a list of tests, got {describe_json_type(tests)}"]
+  store = load_plan_store()
+  plans = []
+  errors = []
+  for i, test in enumerate(tests):
+    if not isinstance(test, dict):
+      plan = compile_test(test)
+    else:
+      key = hashlib.sha256(json.dumps({field: test.get(field) for field in PLAN_FIELDS}, sort_keys=True).encode('utf-8')).hexdigest()
+      if key in store and is_stored_plan_valid(store[key], test):
+        plan = store[key].with_test(test)
       else:
-        results["failed"] += 1
-    elif test["type"] == "junit":
-      for t in test_result:
-        results["results"].append({
-          "name": t["name"],
-          "result": t,
-          "test": test
-        })
-        if t["success"]:
-          results["passed"] += 1
-        else:
-          results["failed"] += 1 
+        plan = compile_test(test)
+        store[key] = plan.with_test(None)
+        plan_store_changed = True
+    plans.append(plan)
+    errors += [f"$[{i}]{error}" for error in plan.errors]
+  save_plan_store()
+  return plans, errors
+
+
+def read_tests(path):
+  # Returns the compiled tests in a json file and the problems with them. A missing file just has no tests
+  try:
+    with open(path, 'r') as file:
+      tests = json.load(file)
+  except FileNotFoundError:
+    return [], []
+  except (OSError, ValueError) as e:
+    return [], [f"$: could not be read as JSON: {e}"]
+  return compile_tests(tests)
+
+
+def get_test_errors_output(file_name, errors):
+  return f"Some of the tests in {file_name} are not formatted correctly, so they were not run. Please fix the following problems:\n" + "".join(f"  {error}\n" for error in errors) + "\n"
+
+
+class TestResult:
+  # One reported result, which refers to its test by the index of its plan instead of holding the test (or the reason, which is only
+  # passed to on_result), so a run's results take little memory however large its tests are
+  __slots__ = ("index", "name", "success", "cached", "skipped")
+
+  def __init__(self, index, name, success, cached, skipped):
+    self.index = index
+    self.name = name
+    self.success = success
+    self.cached = cached
+    self.skipped = skipped
+
+
+@traced
+def run_tests(plans, setup=False, cached_results=None, cache_dir=None, port=None, history=None, fail_fast=None, on_result=None):
+  # Results are reported in the order of the plans as soon as they (and every result before them) are done, by calling
+  # on_result(plan, record, test_result) for each. The tests are run in order of get_test_order instead, which only uses the
+  # history with prioritizeTests, since existing tests may rely on running in the order they were written without saying so
+  results = {"passed": 0, "failed": 0, "results": [], "timed_out": 0}
+
+  # A test that has to run needs the tests it relies on to run before it on the same server, so they are run again even if their
+  # results are cached. Results of tests that rely on other tests aren't cached, since they depend on more than the test itself
+  cached_results = dict(cached_results or {})
+  state_dependencies = get_test_dependencies(plans, load_barriers=False)
+  for i in reversed(range(len(plans))): # dependencies are always earlier tests, so this also reaches their own dependencies
+    if i not in cached_results:
+      for dependency in state_dependencies[i]:
+        cached_results.pop(dependency, None)
+  pending = [i for i in range(len(plans)) if i not in cached_results]
+  history = (history or {}) if config.get("prioritizeTests", False) else {}
+  pending = [pending[i] for i in get_test_order([plans[i] for i in pending], history)]
+  pending_plans = [plans[i] for i in pending]
+
+  junit_plans = [plan for plan in pending_plans if plan.type == "junit" and not plan.errors]
+  # Running the tests is a phase of its own, so like the scripts and maven it may take at most phaseTimeout seconds
+  deadline = time.monotonic() + config.get("phaseTimeout", 600)
+  junit_results = run_junit_tests(junit_plans, setup, deadline) if len(junit_plans) > 0 and not budget_exceeded.is_set() else {}
+
+  def report(i, test_result):
+    plan = plans[i]
+    if plan.type != "junit" or plan.errors:
+      named_results = [(plan.label, test_result)]
+    else:
+      named_results = [(t["name"], t) for t in (test_result if isinstance(test_result, list) else [dict(test_result, name=plan.name)])]
+    for name, t in named_results:
+      record = TestResult(i, name, t["success"], i in cached_results, t.get("skipped", False))
+      results["results"].append(record)
+      results["passed" if record.success else "failed"] += 1
+      if on_result is not None:
+        on_result(plan, record, t)
+
+  concurrency = config.get("testConcurrency", 1)
+  if concurrency > 1 and len(pending_plans) > 1:
+    finished = ((pending[k], test_result) for k, test_result in run_tests_concurrently(pending_plans, setup, junit_results, concurrency, port, fail_fast, deadline))
+  else:
+    finished = ((i, run_test(plans[i], setup, junit_results, port, fail_fast, deadline)) for i in pending)
+  waiting = dict(cached_results) # finished results that can't be reported until the ones before them are
+  next_index = 0
+  def report_ready():
+    nonlocal next_index
+    while next_index in waiting:
+      report(next_index, waiting.pop(next_index))
+      next_index += 1
+
+  report_ready()
+  stored = []
+  for i, test_result in finished:
+    if test_result.get("timedOut", False):
+      results["timed_out"] += 1
+    if cache_dir is not None and len(state_dependencies[i]) == 0 and get_resource_violation() is None:
+      stored += store_cached_results([plans[i]], [test_result], cache_dir)
+    waiting[i] = test_result
+    report_ready()
+  if len(stored) > 0 and get_resource_violation() is not None:
+    # A server that was stopped or throttled for going over resourceLimits may have affected any result of the run
+    remove_cached_results(stored, cache_dir)
 
   results["total"] = len(results["results"])
   return results
 
 
+def get_result_output(test, test_result, cached):
+  output = test_result["reason"]
+  if "description" in test and test["description"]:
+    output = "Description: " + test["description"] + "\n\n" + output
+  if cached:
+    output += "\n\n(This result was reused from a previous run, the test was not run again)"
+  return output
+
+
+testit_session = None
+testit_session_lock = threading.Lock()
+RETRY_STATUSES = {429, 502, 503, 504}
+
+def get_testit_session():
+  # One keep-alive connection to the testit server for every call in a run
+  global testit_session
+  with testit_session_lock:
+    if testit_session is None:
+      testit_session = requests.Session()
+      testit_session.headers.update({'Authorization': AUTH_TOKEN})
+  return testit_session
+
+
+def testit_request(method, path, idempotent=False, **kwargs):
+  # Idempotent calls are retried with jittered exponential backoff, others only if they never reached the server
+  settings = config.get("serverRequests", {})
+  timeout = (settings.get("connectTimeout", 5), settings.get("readTimeout", 60))
+  retries = settings.get("retries", 3)
+  for attempt in range(retries + 1):
+    try:
+      response = get_testit_session().request(method, SERVER_URI + path, timeout=timeout, **kwargs)
+      if not idempotent or response.status_code not in RETRY_STATUSES or attempt == retries:
+        return response
+    except (requests.ConnectionError, requests.Timeout) as e:
+      if not (idempotent or isinstance(e, requests.ConnectTimeout)) or attempt == retries:
+        raise
+    time.sleep(random.uniform(0, min(settings.get("maxBackoff", 10), settings.get("backoff", 0.5) * 2 ** attempt)))
+
+
+@traced
 def check_database_health():
-  url = f"{SERVER_URI}/"
-  headers = {'Authorization': AUTH_TOKEN}
   try:
-    response = requests.get(url, headers=headers)
+    response = testit_request("GET", "/", idempotent=True)
     return response.status_code == 200
   except requests.RequestException:
     return False
@@ -188,36 +1370,351 @@ def get_assignment_title():
   return clean_title(metadata['assignment']['title'])
 
 
-def upload_tests(assignment_title, student_id, tests, params):
+@traced
+def upload_tests(assignment_title, student_id, tests, params, bundle=None):
+  # With the tests the database returned last time, it only sends the ones that are new (or nothing if none changed)
+  # Tests are stored by name and the author's own tests don't count against maxTestsPerStudent, so uploading them again (e.g. when
+  # a retry follows an attempt whose response was lost) doesn't change anything
   encoded_id = base64.b64encode(student_id.encode('utf-8')).decode('utf-8') # just not in plaintext, but isn't sensitive anyway
-  url = f"{SERVER_URI}/submit-tests/{assignment_title}?id={encoded_id}"
-  headers = {'Content-Type': 'application/json', 'Authorization': AUTH_TOKEN}
-  response = requests.post(url, params=params, json=tests, headers=headers)
-  return response
+  headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip', 'Accept-Encoding': 'gzip'}
+  body = {"tests": tests, "knownTests": []}
+  if bundle is not None:
+    headers['If-None-Match'] = bundle["etag"]
+    body["knownTests"] = bundle["order"]
+  return testit_request("POST", f"/submit-tests/{assignment_title}?id={encoded_id}", idempotent=True, params=params, data=gzip.compress(json.dumps(body).encode('utf-8')), headers=headers)
 
 
-def upload_results(assignment_title, student_id, results):
-  encoded_id = base64.b64encode(student_id.encode('utf-8')).decode('utf-8') # just not in plaintext, but isn't sensitive anyway
-  url = f"{SERVER_URI}/submit-results/{assignment_title}?id={encoded_id}"
-  headers = {'Content-Type': 'application/json', 'Authorization': AUTH_TOKEN}
-  response = requests.post(url, json=results, headers=headers)
-  return response
+@traced
+def upload_results(upload):
+  # The database only records the results once for each key, so the upload can be retried
+  encoded_id = base64.b64encode(upload["id"].encode('utf-8')).decode('utf-8') # just not in plaintext, but isn't sensitive anyway
+  return testit_request("POST", f"/submit-results/{upload['assignment']}", idempotent=True, params={"id": encoded_id, "key": upload["key"]}, json=upload["results"])
+
+
+def get_results_upload(assignment_title, student_id, results):
+  return {"assignment": assignment_title, "id": student_id, "key": uuid.uuid4().hex, "results": results}
+
+
+def get_pending_uploads_dir():
+  return os.path.join(config.get("cacheDir", f"{SOURCE_DIR}/test-grader/cache"), "pending-uploads")
+
+
+def queue_pending_upload(upload):
+  # Results that couldn't be uploaded are kept until a later run can upload them
+  path = os.path.join(get_pending_uploads_dir(), upload["key"] + ".json")
+  try:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.{os.getpid()}.tmp", 'w') as file:
+      json.dump(upload, file)
+    os.replace(f"{path}.{os.getpid()}.tmp", path)
+    return True
+  except OSError as e:
+    print(f"Could not save the results to upload later in {path}: {e}")
+    return False
+
+
+def upload_results_bulk(uploads):
+  # One request for every batch uploadSize submissions of an assignment, returns the database's status of each (None if the request failed)
+  size = get_batch_config().get("uploadSize", 100)
+  uploaded = []
+  for i in range(0, len(uploads), size):
+    chunk = uploads[i:i + size]
+    submissions = [{"id": base64.b64encode(upload["id"].encode('utf-8')).decode('utf-8'), "key": upload["key"], "results": upload["results"]} for upload in chunk]
+    try:
+      response = testit_request("POST", f"/submit-results-bulk/{chunk[0]['assignment']}", idempotent=True, json=submissions)
+      statuses = response.json()["submissions"] if response.status_code == 200 else [None] * len(chunk)
+    except (requests.RequestException, ValueError, KeyError):
+      statuses = [None] * len(chunk)
+    uploaded += statuses
+  return uploaded
+
+
+@traced
+def flush_pending_uploads():
+  # Returns how many queued uploads were recorded
+  try:
+    names = sorted(name for name in os.listdir(get_pending_uploads_dir()) if name.endswith(".json"))
+  except OSError:
+    return 0
+  uploads = collections.defaultdict(list)
+  for name in names:
+    try:
+      with open(os.path.join(get_pending_uploads_dir(), name), 'r') as file:
+        upload = json.load(file)
+      uploads[upload["assignment"]].append(upload)
+    except (OSError, ValueError, KeyError):
+      continue
+  flushed = 0
+  for assignment_uploads in uploads.values():
+    for upload, status in zip(assignment_uploads, upload_results_bulk(assignment_uploads)):
+      # Uploads the database rejected (e.g. for an unknown student) would never succeed, so they are dropped too
+      if status is not None and (status["success"] or "reason" in status):
+        with contextlib.suppress(OSError):
+          os.remove(os.path.join(get_pending_uploads_dir(), upload["key"] + ".json"))
+        flushed += 1 if status["success"] else 0
+  return flushed
+
+
+def get_bundle_path(assignment_title, student_id):
+  # The default tests are stored by --setup, so they are also in the image that every submission is graded in
+  name = "defaults" if student_id is None else hashlib.sha256(student_id.encode('utf-8')).hexdigest()
+  return os.path.join(config.get("cacheDir", f"{SOURCE_DIR}/test-grader/cache"), "bundles", assignment_title, name + ".json")
+
+
+def load_bundle(assignment_title, student_id):
+  if not config.get("cacheTestBundles", True):
+    return None
+  try:
+    with open(get_bundle_path(assignment_title, student_id), 'r') as file:
+      return json.load(file)
+  except (OSError, ValueError):
+    return None
+
+
+def save_bundle(assignment_title, student_id, bundle):
+  if bundle is None or not config.get("cacheTestBundles", True):
+    return
+  path = get_bundle_path(assignment_title, student_id)
+  try:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.{os.getpid()}.tmp", 'w') as file:
+      file.write(json.dumps(bundle)) # json.dump doesn't use the C encoder
+    os.replace(f"{path}.{os.getpid()}.tmp", path)
+  except OSError as e:
+    print(f"Could not write the test bundle cache {path}: {e}")
+
+
+def get_bundle_tests(json_response, bundle):
+  # Rebuilds the full list of tests from the database's response and the cached bundle, and the bundle to cache next
+  if json_response.get("notModified", False):
+    return bundle["tests"], dict(bundle, savedAt=time.time())
+  known_tests = dict(zip(bundle["order"], bundle["tests"])) if bundle is not None else {}
+  known_tests.update(json_response["newTests"])
+  tests = [known_tests[test_hash] for test_hash in json_response["order"]]
+  return tests, {"etag": json_response["etag"], "savedAt": time.time(), "order": json_response["order"], "tests": tests}
+
+
+def get_fallback_tests(assignment_title, student_id):
+  # The tests the database last returned to this student, or else the default tests
+  for owner in [student_id, None]:
+    bundle = load_bundle(assignment_title, owner)
+    if bundle is not None:
+      saved_at = datetime.fromtimestamp(bundle["savedAt"], pytz.timezone("US/Eastern")).strftime("%Y-%m-%d %H:%M %Z")
+      description = f"the tests returned on your last submission ({saved_at})" if owner is not None else "the default tests"
+      return bundle["tests"], description
+  return None, None
+
+
+def probe_server(probe):
+  try:
+    if "url" in probe:
+      requests.get(probe["url"], timeout=1) # any response means the server is up
+    else:
+      socket.create_connection((probe.get("host", "localhost"), probe["port"]), timeout=1).close()
+    return True
+  except (OSError, requests.RequestException):
+    return False
+
+
+def wait_until_ready(probe, port=None):
+  # Polls the server with exponential backoff, returns the seconds it took to be ready or None if it timed out
+  if port is not None:
+    probe = {**probe, "port": port} if "port" in probe else {**probe, "url": rewrite_port(probe["url"], port)}
+  start = time.monotonic()
+  deadline = start + bounded_timeout(probe.get("timeout", 60))
+  delay = 0.05
+  while not probe_server(probe):
+    if time.monotonic() >= deadline:
+      return None
+    time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+    delay = min(delay * 2, 1)
+  return time.monotonic() - start
+
+
+class ResourceMonitor:
+  # Samples the CPU time, memory, open files and threads of every process in a process group from /proc, and enforces resourceLimits
+  __slots__ = ("pgid", "label", "limits", "stop_event", "thread", "start_cpu", "cpu", "peak", "violation")
+
+  def __init__(self, pgid, label):
+    self.pgid = pgid
+    self.label = label
+    self.limits = config.get("resourceLimits") or {}
+    self.stop_event = threading.Event()
+    self.thread = None
+    self.start_cpu = None # CPU time of the processes already running when monitoring started, which isn't counted
+    self.cpu = {} # pid -> CPU seconds used since monitoring started
+    self.peak = {"rss_mb": 0, "open_files": 0, "threads": 0, "processes": 0}
+    self.violation = None
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    # Returns the usage of the process group while it was monitored
+    self.stop_event.set()
+    self.thread.join()
+    self.sample()
+    usage = {"cpu_seconds": round(sum(self.cpu.values()), 3), "peak_rss_mb": round(self.peak["rss_mb"], 1), "peak_open_files": self.peak["open_files"], "peak_threads": self.peak["threads"], "peak_processes": self.peak["processes"]}
+    if self.violation is not None:
+      usage["violation"] = self.violation
+    return usage
+
+  def run(self):
+    interval = config.get("resourceSampleInterval", 0.5)
+    while True:
+      self.sample()
+      if self.stop_event.wait(interval):
+        return
+
+  def read_group(self):
+    # Returns (pid, cpu seconds, rss bytes, threads, open files) of every process in the group
+    processes = []
+    for pid in os.listdir('/proc'):
+      if not pid.isdigit():
+        continue
+      try:
+        with open(f'/proc/{pid}/stat', 'r') as file:
+          fields = file.read().rpartition(')')[2].split() # the command name before it may contain spaces
+        if int(fields[2]) != self.pgid:
+          continue
+        open_files = len(os.listdir(f'/proc/{pid}/fd'))
+      except (OSError, IndexError, ValueError):
+        continue # the process exited while it was being read
+      processes.append((int(pid), (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, int(fields[21]) * PAGE_SIZE, int(fields[17]), open_files))
+    return processes
+
+  def sample(self):
+    processes = self.read_group()
+    if self.start_cpu is None:
+      self.start_cpu = {pid: cpu for pid, cpu, _, _, _ in processes}
+    for pid, cpu, _, _, _ in processes:
+      self.cpu[pid] = cpu - self.start_cpu.get(pid, 0)
+    current = {"rss_mb": sum(p[2] for p in processes) / (1024 * 1024), "threads": sum(p[3] for p in processes), "open_files": sum(p[4] for p in processes), "processes": len(processes)}
+    for key, value in current.items():
+      self.peak[key] = max(self.peak[key], value)
+    if self.violation is None:
+      self.check_limits(sum(self.cpu.values()), current)
+
+  def check_limits(self, cpu_seconds, current):
+    values = {"maxCpuSeconds": cpu_seconds, "maxRssMb": current["rss_mb"], "maxOpenFiles": current["open_files"], "maxThreads": current["threads"], "maxProcesses": current["processes"]}
+    for limit, value in values.items():
+      if limit in self.limits and value > self.limits[limit]:
+        self.violation = f"{limit} is {self.limits[limit]}, but it used {value:.4g}"
+        break
+    if self.violation is None:
+      return
+    # Memory can't be throttled, so a server over maxRssMb is always stopped
+    if self.limits.get("action", "kill") == "throttle" and not self.violation.startswith("maxRssMb"):
+      self.violation += " (its priority was lowered)"
+      try:
+        os.setpriority(os.PRIO_PGRP, self.pgid, 19)
+      except OSError:
+        pass
+    else:
+      self.violation += " (it was stopped)"
+      try:
+        os.killpg(self.pgid, signal.SIGKILL)
+      except OSError:
+        pass
+
 
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+resource_monitors = {} # pgid -> ResourceMonitor
+resource_usage = {} # label -> usage of the server that was monitored, added to results.json
 
-def pre_test(submission_path):
-  process = subprocess.Popen(["bash", "/autograder/source/sample-submission/pre-test.sh"], cwd=submission_path, start_new_session=True)
+def start_resource_monitor(pgid, submission_path):
+  if not os.path.isdir('/proc') or config.get("resourceSampleInterval", 0.5) is None:
+    return
+  monitor = ResourceMonitor(pgid, "sample" if submission_path == SAMPLE_RUN_DIR else "student")
+  resource_monitors[pgid] = monitor
+  monitor.start()
+
+
+def get_resource_violation():
+  # The violation of a server that is still being monitored, if any of them went over resourceLimits
+  return next((monitor.violation for monitor in list(resource_monitors.values()) if monitor.violation is not None), None)
+
+
+def stop_resource_monitor(pgid):
+  # Returns the usage of the server started by pre_test, or None if it wasn't monitored
+  monitor = resource_monitors.pop(pgid, None)
+  if monitor is None:
+    return None
+  usage = monitor.stop()
+  resource_usage[monitor.label] = usage
+  return usage
+
+
+def get_resource_output(usage, owner):
+  if usage is None:
+    return ""
+  output = f"{owner} used {usage['cpu_seconds']:.2f} seconds of CPU time while the tests ran, and at most {usage['peak_rss_mb']:.1f} MB of memory, {usage['peak_open_files']} open files and {usage['peak_threads']} threads.\n"
+  if "violation" in usage:
+    output += f"{owner} went over the resource limits: {usage['violation']}.\n"
+  return output
+
+
+def get_resource_limits_feedback(usage):
+  return {
+    "name": "Server stayed within the resource limits",
+    "status": "failed" if "violation" in usage else "passed",
+    "score": 0,
+    "max_score": 0,
+    "output": get_resource_output(usage, "Your server"),
+    "visibility": "visible",
+    "test-data": {
+      "isDefault": False,
+      "createdAt": "",
+      "public": False,
+      "selfWritten": False
+    }
+  }
+
+
+@traced
+def pre_test(submission_path, port=None):
+  # If a port is given, the server is told to listen on it through the PORT environment variable
+  env = None if port is None else dict(os.environ, PORT=str(port))
+  process = subprocess.Popen(["bash", f"{SAMPLE_DIR}/pre-test.sh"], cwd=submission_path, start_new_session=True, env=env)
   pgid = os.getpgid(process.pid)
-  process.wait()
-  time.sleep(config["waitTimeAfterPreTest"])
+  active_process_groups.add(pgid)
+  timeout = bounded_timeout(config.get("phaseTimeout", 600))
+  try:
+    process.wait(timeout=timeout)
+  except subprocess.TimeoutExpired:
+    try:
+      os.killpg(pgid, signal.SIGKILL)
+    except OSError:
+      pass
+    active_process_groups.discard(pgid)
+    return None, f"Pre-test script did not finish within {timeout:.0f} seconds.", ""
+  probe = config.get("readinessProbe")
+  if probe is None:
+    time.sleep(bounded_timeout(config["waitTimeAfterPreTest"]))
   if process.returncode != 0:
-    return None, f"Pre-test script failed with return code {process.returncode}."
-  return pgid, ""
+    return None, f"Pre-test script failed with return code {process.returncode}.", ""
+  start_resource_monitor(pgid, submission_path)
+  if probe is None:
+    return pgid, "", ""
+  ready_time = wait_until_ready(probe, port)
+  if ready_time is None:
+    return pgid, "", f"Server was not ready after {probe.get('timeout', 60)} seconds, running the tests anyway.\n"
+  return pgid, "", f"Server was ready {ready_time:.2f} seconds after the pre-test script finished.\n"
 
 
+@traced
 def post_test(pre_pgid, submission_path):
-  process = subprocess.Popen(["bash", "/autograder/source/sample-submission/post-test.sh"], cwd=submission_path, start_new_session=True)
+  stop_resource_monitor(pre_pgid)
+  process = subprocess.Popen(["bash", f"{SAMPLE_DIR}/post-test.sh"], cwd=submission_path, start_new_session=True)
   pgid = os.getpgid(process.pid)
-  process.wait()
+  timeout = bounded_timeout(config.get("phaseTimeout", 600), minimum=10) # still give cleanup a chance once the budget is used up
+  timed_out = False
+  try:
+    process.wait(timeout=timeout)
+  except subprocess.TimeoutExpired:
+    timed_out = True
   try:
     os.killpg(pgid, signal.SIGTERM)
   except:
@@ -226,126 +1723,218 @@ def post_test(pre_pgid, submission_path):
     os.killpg(pre_pgid, signal.SIGTERM) # Terminate leftover processes
   except:
     pass
+  active_process_groups.discard(pre_pgid)
+  if timed_out:
+    return f"Post-test script did not finish within {timeout:.0f} seconds."
   if process.returncode != 0:
     return f"Post-test script failed with return code {process.returncode}."
   return ""
 
 
-def write_output(data):
-  due_date_str = metadata["assignment"]["due_date"]
-  due_date_format = "%Y-%m-%dT%H:%M:%S.%f%z"  # e.g. 2024-01-21T23:00:00.000000-07:00
-  due_date = datetime.strptime(due_date_str, due_date_format)
-  created_at_format = "%Y-%m-%dT%H:%M:%S.%fZ" # e.g. 2024-02-01T17:04:11.668Z
-
-  eastern = pytz.timezone("US/Eastern")
-  print("Assignment due date: " + due_date.astimezone(eastern).strftime("%Y-%m-%d %H:%M:%S %Z%z"))
-
-  passed_defaults = True
-  valid_public_tests = 0
-  for test_feedback in data["tests"]:
+active_results_writer = None # the ResultsWriter that hasn't been closed yet, so it can still be finished if grading runs over the budget
+
+class ResultsWriter:
+  # Writes results.json as feedback is added instead of keeping all of it until the end. Anything already in results.json is kept,
+  # and the file is only replaced once it's complete
+  __slots__ = ("path", "file", "lock", "existing", "count", "score", "due_date", "passed_defaults", "valid_public_tests")
+
+  def __init__(self):
+    global active_results_writer
+    self.path = f'{RESULTS_DIR}/results.json'
+    self.existing = {}
+    if os.path.exists(self.path):
+      with open(self.path, 'r') as file:
+        self.existing = json.load(file)
+    self.file = tempfile.NamedTemporaryFile('w', dir=RESULTS_DIR, prefix="results.json.", suffix=".tmp", delete=False)
+    self.lock = threading.RLock() # exit_over_budget may close the file from another thread
+    self.file.write('{"tests": [')
+    self.count = 0
+    self.score = 0
+    for test in self.existing.pop("tests", []):
+      self.write(test)
+
+    due_date_str = metadata["assignment"]["due_date"]
+    due_date_format = "%Y-%m-%dT%H:%M:%S.%f%z"  # e.g. 2024-01-21T23:00:00.000000-07:00
+    self.due_date = datetime.strptime(due_date_str, due_date_format)
+    print("Assignment due date: " + self.due_date.astimezone(pytz.timezone("US/Eastern")).strftime("%Y-%m-%d %H:%M:%S %Z%z"))
+    self.passed_defaults = True
+    self.valid_public_tests = 0
+    active_results_writer = self
+
+  def write(self, test_feedback):
+    with self.lock:
+      if self.file.closed:
+        return
+      self.file.write(("," if self.count > 0 else "") + json.dumps(test_feedback))
+      self.count += 1
+
+  def add(self, test_feedback):
+    created_at_format = "%Y-%m-%dT%H:%M:%S.%fZ" # e.g. 2024-02-01T17:04:11.668Z
+    eastern = pytz.timezone("US/Eastern")
     test = test_feedback["test-data"]
     if test["isDefault"] and test_feedback["status"] == "failed":
-      passed_defaults = False
+      self.passed_defaults = False
     if not test["isDefault"] and test["public"] and test["selfWritten"]:
       created_at_str = test["createdAt"]
       created_at = datetime.strptime(created_at_str, created_at_format)
       created_at = pytz.timezone('UTC').localize(created_at)
 
-      time_difference = due_date - created_at
+      time_difference = self.due_date - created_at
       hours_before_due = time_difference.total_seconds() / 3600
       print(f"Test {test_feedback['name']} was created at {created_at.astimezone(eastern).strftime('%Y-%m-%d %H:%M:%S %Z%z')}, {hours_before_due} hours before due")
 
       if hours_before_due >= config["timeToDeadline"]:
-        valid_public_tests += 1
+        self.valid_public_tests += 1
+    self.score += test_feedback["score"]
+    self.write(test_feedback)
+
+  def close(self, output):
+    global active_results_writer
+    with self.lock:
+      if self.file.closed:
+        return
+      self.finish(output)
+    if active_results_writer is self:
+      active_results_writer = None
+
+  def finish(self, output):
+    public_tests_passed = {
+      "name": f"Submitted at least {config['numPublicTestsForAccess']} public test(s) {config['timeToDeadline']} hours before deadline",
+      "status": "passed" if self.valid_public_tests >= config["numPublicTestsForAccess"] else "failed",
+      "score": config["submitTestsScore"] if self.valid_public_tests >= config["numPublicTestsForAccess"] else 0,
+      "max_score": config["submitTestsScore"],
+      "visibility": "visible",
+    }
+    public_defaults_passed = {
+      "name": "Passed all of the default tests",
+      "status": "passed" if self.passed_defaults else "failed",
+      "score": config["groupedDefaultTestsScore"] if self.passed_defaults else 0,
+      "max_score": config["groupedDefaultTestsScore"],
+      "visibility": "visible",
+    }
+    for grouped_test, score in [(public_tests_passed, config["submitTestsScore"]), (public_defaults_passed, config["groupedDefaultTestsScore"])]:
+      if score > 0:
+        self.score += grouped_test["score"]
+        self.write(grouped_test)
+
+    existing_data = self.existing
+    if "score" in existing_data:
+      existing_data["score"] += self.score
+    if "output" in existing_data:
+      existing_data["output"] += "\n\n" + output
+    else:
+      existing_data["output"] = output
+    existing_data.setdefault("extra_data", {})["timings"] = get_timing_summary()
+    if len(resource_usage) > 0:
+      existing_data["extra_data"]["resources"] = resource_usage
+
+    self.file.write("], " + json.dumps(existing_data)[1:])
+    self.file.close()
+    os.chmod(self.file.name, 0o644) # temporary files are only readable by their owner
+    os.replace(self.file.name, self.path)
+
+
+def write_output(data):
+  writer = ResultsWriter()
+  for test_feedback in data["tests"]:
+    writer.add(test_feedback)
+  writer.close(data.get("output", ""))
 
-  public_tests_passed = {
-    "name": f"Submitted at least {config['numPublicTestsForAccess']} public test(s) {config['timeToDeadline']} hours before deadline",
-    "status": "passed" if valid_public_tests >= config["numPublicTestsForAccess"] else "failed",
-    "score": config["submitTestsScore"] if valid_public_tests >= config["numPublicTestsForAccess"] else 0,
-    "max_score": config["submitTestsScore"],
+
+def get_sample_feedback(plan, record, test_result):
+  return {
+    "name": "SAMPLE SOLUTION RESULT: " + record.name,
+    "status": "failed" if not record.success else "passed",
+    "score": 0,
+    "max_score": 0,
+    "output": get_result_output(plan.test, test_result, record.cached),
     "visibility": "visible",
+    "test-data": {
+      "isDefault": False,
+      "createdAt": "",
+      "public": False,
+      "selfWritten": False
+    }
   }
-  public_defaults_passed = {
-    "name": "Passed all of the default tests",
-    "status": "passed" if passed_defaults else "failed",
-    "score": config["groupedDefaultTestsScore"] if passed_defaults else 0,
-    "max_score": config["groupedDefaultTestsScore"],
+
+
+def get_student_feedback(plan, record, test_result):
+  test = plan.test
+  return {
+    "name": record.name,
+    "status": "failed" if not record.success else "passed",
+    "score": test["score"] if test.get("isDefault", False) and "score" in test and record.success else 0,
+    "max_score": test["max_score"] if test.get("isDefault", False) and "max_score" in test else (test["score"] if test.get("isDefault", False) and "score" in test else 0),
+    "output": get_result_output(test, test_result, record.cached),
     "visibility": "visible",
+    "test-data": {
+      "isDefault": test.get("isDefault", False),
+      "createdAt": test.get("createdAt", ""),
+      "public": test.get("public", False),
+      "selfWritten": test.get("selfWritten", False)
+    }
   }
 
-  if config["submitTestsScore"] > 0:
-    data["tests"].append(public_tests_passed)
-  if config["groupedDefaultTestsScore"] > 0:
-    data["tests"].append(public_defaults_passed)
 
-  results_file = '/autograder/results/results.json'
-  if os.path.exists(results_file):
-    with open(results_file, 'r') as file:
-      existing_data = json.load(file)
-  else:
-    existing_data = {}
-
-  if "score" in existing_data:
-    for test in data["tests"]:
-      existing_data["score"] += test["score"]
-  
-  if "output" in existing_data and "output" in data:
-    existing_data["output"] += "\n\n" + data["output"]
-  else:
-    existing_data["output"] = data.get("output", "")
-  
-  if "tests" in data:
-    existing_data.setdefault("tests", []).extend(data["tests"])
-  
-  with open(results_file, 'w') as file:
-    json.dump(existing_data, file)
+def get_successful_tests(plans, results):
+  # The tests that passed, once each (a JUnit test passes if any of its test cases did)
+  successful_tests = []
+  successful_test_names = set()
+  for record in results["results"]:
+    test = plans[record.index].test
+    if record.success and test["name"] not in successful_test_names:
+      successful_tests.append(test)
+      successful_test_names.add(test["name"])
+  return successful_tests
 
 
 def main():
+  load_batch_job()
   load_config()
   load_metadata()
+  start_grading_budget()
   
-  # Read tests
-  try:
-    with open('/autograder/submission/tests.json', 'r') as file:
-      tests = json.load(file)
-  except:
-    tests = []
+  # Read and check tests
+  tests, test_errors = read_tests(f'{SUBMISSION_DIR}/tests.json')
+
+  # With separate ports, the student's submission can start up while the tests run on the sample solution
+  sample_port, student_port, student_startup = None, None, None
+  if batch_job is not None:
+    sample_port, student_port = batch_job["samplePort"], batch_job["studentPort"]
+  elif config.get("parallelPhases") is not None:
+    sample_port = config["parallelPhases"].get("samplePort", 3001)
+    student_port = config["parallelPhases"].get("studentPort", 3002)
+  if config.get("parallelPhases") is not None:
+    student_startup = concurrent.futures.ThreadPoolExecutor(max_workers=1).submit(pre_test, SUBMISSION_DIR, student_port)
   
   output_str = ""
+  if len(test_errors) > 0:
+    output_str += get_test_errors_output("tests.json", test_errors)
   if len(tests) > 0:
-    # Run tests on sample submission
-    pre_pgid, err = pre_test("/autograder/source/sample-submission")
-    if err != "":
-      write_output({"output": f"Error running pre-test script for sample submission:, please contact assignment administrators:\n{err}", "tests": []})
-      return
-    sample_results = run_tests(tests)
-    err = post_test(pre_pgid, "/autograder/source/sample-submission")
-    if err != "":
-      write_output({"output": f"Error running post-test script for sample submission:, please contact assignment administrators:\n{err}", "tests": []})
-      return
-
-    # Format feedback and ensure they passed sample
-    feedback = [{
-      "name": "SAMPLE SOLUTION RESULT: " + result["name"],
-      "status": "failed" if not result["result"]["success"] else "passed",
-      "score": 0 if not result["result"]["success"] else 0,
-      "max_score": 0,
-      "output": "Description: " + result["test"]["description"] + "\n\n" + result["result"]["reason"] if "description" in result["test"] and result["test"]["description"] else result["result"]["reason"],
-      "visibility": "visible",
-      "test-data": {
-        "isDefault": False,
-        "createdAt": "",
-        "public": False,
-        "selfWritten": False
-      }
-    } for result in sample_results["results"]]
-    successful_tests = []
-    successful_test_names = []
-    for result in sample_results["results"]:
-      if result["result"]["success"] and result["test"]["name"] not in successful_test_names:
-        successful_tests.append(result["test"])
-        successful_test_names.append(result["test"]["name"])
+    # Run tests on sample submission, only starting it if some results aren't cached
+    sample_cache_dir = get_sample_cache_dir()
+    cached_results = load_cached_results(tests, sample_cache_dir)
+    all_cached = len(cached_results) == len(tests)
+    if not all_cached:
+      pre_pgid, err, startup_msg = pre_test(SAMPLE_RUN_DIR, sample_port)
+      if err != "":
+        write_output({"output": f"Error running pre-test script for sample submission:, please contact assignment administrators:\n{err}", "tests": []})
+        return
+      if startup_msg:
+        output_str += "Sample solution: " + startup_msg
+    # Format feedback (there are at most maxTestsPerStudent of these, so they are kept until the output is written)
+    feedback = []
+    sample_results = run_tests(tests, cached_results=cached_results, cache_dir=sample_cache_dir, port=sample_port, on_result=lambda plan, record, test_result: feedback.append(get_sample_feedback(plan, record, test_result)))
+    if not all_cached:
+      err = post_test(pre_pgid, SAMPLE_RUN_DIR)
+      if err != "":
+        write_output({"output": f"Error running post-test script for sample submission:, please contact assignment administrators:\n{err}", "tests": []})
+        return
+      if "violation" in resource_usage.get("sample", {}):
+        output_str += get_resource_output(resource_usage["sample"], "The sample solution's server") + "Please contact the assignment administrators.\n"
+
+    # Ensure they passed sample
+    successful_tests = get_successful_tests(tests, sample_results)
 
     if sample_results["total"] != sample_results["passed"]:
       output_str += "Some test cases did not pass sample implementation. If you believe any of these to be a mistake, please contact the assignment administrators. Only test cases that pass this sample may be uploaded. You can find the outcomes of running your tests on THE SAMPLE SOLUTION below.\n"
@@ -356,57 +1945,90 @@ def main():
     feedback = []
     successful_tests = []
 
-  # Ensure database is running
-  if not check_database_health():
-    write_output({"output": "Server is not running or not healthy. Please contact the assignment administrators. In the meantime, here are the outcomes of running your tests on THE SAMPLE SOLUTION.\n" + output_str, "tests": feedback})
-    return
   student_id = metadata['users'][0]['email']
   assignment_title = get_assignment_title()
 
-  # Upload tests to the database, get response of all tests
-  response = upload_tests(assignment_title, student_id, successful_tests, config)
-  if response.status_code < 200 or response.status_code >= 300:
-    write_output({"output": f"Error uploading tests to the database. Please contact the assignment administrators. Response status {response.status_code}:\n{response.text}\nIn the meantime, here are the outcomes of running your tests on THE SAMPLE SOLUTION.\n" + output_str, "tests": feedback})
-    return
-  json_response = response.json()
-  if not json_response['success']:
-    write_output({"output": "Error uploading tests to the database. Please contact the assignment administrators. In the meantime, here are the outcomes of running your tests on THE SAMPLE SOLUTION.\n" + output_str, "tests": feedback})
-    return
-  elif len(json_response['failedToAdd']) > 0:
-    output_str += "Failed to upload all tests to the database. Make sure test names are unique if you want them to be counted seperately! Please see the following reasons:\n\n"
-    for failure in json_response['failedToAdd']:
-      output_str += failure['name'] + ": \t" + failure['reason'] + "\n"
-    output_str += "\n"
-  elif len(successful_tests) > 0:
-    output_str += "All tests successfully uploaded to the database!\n"
-  all_tests = response.json()['tests']
-
-  # Run tests on student submission
-  student_pre_pgid, err = pre_test("/autograder/submission")
-  if err != "":
-    write_output({"output": f"Error running pre-test script for student submission, please contact assignment administrators:\n{err}\nIn the meantime, here are the outcomes of running your tests on THE SAMPLE SOLUTION.\n" + output_str, "tests": feedback})
-    return
-  all_results = run_tests(all_tests)
-  err = post_test(student_pre_pgid, "/autograder/submission")
-  if err != "":
-    write_output({"output": f"Error running post-test script for student submission, please contact assignment administrators:\n{err}\nIn the meantime, here are the outcomes of running your tests on THE SAMPLE SOLUTION.\n" + output_str, "tests": feedback})
-    return
-  
-  # Format feedback and return results
-  feedback += [{
-    "name": result["name"],
-    "status": "failed" if not result["result"]["success"] else "passed",
-    "score": result["test"]["score"] if result["test"].get("isDefault", False) and "score" in result["test"] and result["result"]["success"] else 0,
-    "max_score": result["test"]["max_score"] if result["test"].get("isDefault", False) and "max_score" in result["test"] else (result["test"]["score"] if result["test"].get("isDefault", False) and "score" in result["test"] else 0),
-    "output": "Description: " + result["test"]["description"] + "\n\n" + result["result"]["reason"] if "description" in result["test"] and result["test"]["description"] else result["result"]["reason"],
-    "visibility": "visible",
-    "test-data": {
-      "isDefault": result["test"].get("isDefault", False),
-      "createdAt": result["test"].get("createdAt", ""),
-      "public": result["test"].get("public", False),
-      "selfWritten": result["test"].get("selfWritten", False)
-    }
-  } for result in all_results["results"]]
+  # Ensure database is running, then upload tests to the database and get all of the tests to run
+  database_error = None
+  history = {}
+  if not check_database_health():
+    database_error = "Server is not running or not healthy. Please contact the assignment administrators."
+  else:
+    if batch_job is None:
+      flush_pending_uploads() # a batch uploads them once all of its submissions are graded
+    bundle = load_bundle(assignment_title, student_id)
+    try:
+      response = upload_tests(assignment_title, student_id, successful_tests, config, bundle)
+    except requests.RequestException as e:
+      database_error = f"Error uploading tests to the database. Please contact the assignment administrators. The request failed: {e}"
+    else:
+      json_response = response.json() if 200 <= response.status_code < 300 else None
+      if json_response is None:
+        database_error = f"Error uploading tests to the database. Please contact the assignment administrators. Response status {response.status_code}:\n{response.text}"
+      elif not json_response['success']:
+        database_error = "Error uploading tests to the database. Please contact the assignment administrators."
+      else:
+        if len(json_response['failedToAdd']) > 0:
+          output_str += "Failed to upload all tests to the database. Make sure test names are unique if you want them to be counted seperately! Please see the following reasons:\n\n"
+          for failure in json_response['failedToAdd']:
+            output_str += failure['name'] + ": \t" + failure['reason'] + "\n"
+          output_str += "\n"
+        elif len(successful_tests) > 0:
+          output_str += "All tests successfully uploaded to the database!\n"
+        server_tests, bundle = get_bundle_tests(json_response, bundle)
+        save_bundle(assignment_title, student_id, bundle)
+        history = json_response.get("history", {})
+  if database_error is not None:
+    # Run the last tests the database returned instead, if they were cached
+    server_tests, fallback_description = get_fallback_tests(assignment_title, student_id)
+    if server_tests is None:
+      write_output({"output": database_error + "\nIn the meantime, here are the outcomes of running your tests on THE SAMPLE SOLUTION.\n" + output_str, "tests": feedback})
+      return
+    output_str += f"{database_error}\nIn the meantime, {fallback_description} were run on your submission instead. Your tests were not uploaded, so please resubmit once the server is back.\n"
+  all_tests, test_errors = compile_tests(server_tests)
+  if len(test_errors) > 0:
+    output_str += get_test_errors_output("the tests returned by the database", test_errors)
+
+  # Run tests on student submission, only starting it if some results can't be reused from an earlier run
+  student_cache_dir = get_student_cache_dir()
+  cached_results = load_cached_results(all_tests, student_cache_dir)
+  all_cached = len(cached_results) == len(all_tests)
+  student_started = student_startup is not None or not all_cached
+  if student_started:
+    if student_startup is not None:
+      student_pre_pgid, err, startup_msg = student_startup.result()
+    else:
+      student_pre_pgid, err, startup_msg = pre_test(SUBMISSION_DIR, student_port)
+    if err != "":
+      write_output({"output": f"Error running pre-test script for student submission, please contact assignment administrators:\n{err}\nIn the meantime, here are the outcomes of running your tests on THE SAMPLE SOLUTION.\n" + output_str, "tests": feedback})
+      return
+    if startup_msg:
+      output_str += "Your submission: " + startup_msg
+  # The feedback of each test is written to results.json as soon as it is done
+  results_writer = ResultsWriter()
+  for test_feedback in feedback:
+    results_writer.add(test_feedback)
+  fail_fast = get_fail_fast()
+  all_results = run_tests(all_tests, cached_results=cached_results, cache_dir=student_cache_dir, port=student_port, history=history, fail_fast=fail_fast, on_result=lambda plan, record, test_result: results_writer.add(get_student_feedback(plan, record, test_result)))
+  if student_started:
+    err = post_test(student_pre_pgid, SUBMISSION_DIR)
+    if err != "":
+      results_writer.close(f"Error running post-test script for student submission, please contact assignment administrators:\n{err}\nIn the meantime, here are the outcomes of running the tests.\n" + output_str)
+      return
+  if student_started:
+    output_str += "\n" + get_resource_output(resource_usage.get("student"), "Your server")
+  if budget_exceeded.is_set():
+    output_str += f"\nGrading ran out of time (the time budget is {config['gradingBudget']} seconds), so some tests were skipped and are marked as failed below.\n"
+  if all_results["timed_out"] > 0:
+    output_str += f"\nRunning the tests took longer than {config.get('phaseTimeout', 600)} seconds, so the last {all_results['timed_out']} tests were skipped and are marked as failed below.\n"
+  skipped_count = sum(1 for record in all_results["results"] if record.skipped)
+  if skipped_count > 0:
+    output_str += f"\n{fail_fast.limit} tests failed, so the {skipped_count} tests after them were skipped to give you feedback sooner. The default tests were all run, and every test is run on submissions at or after the deadline.\n"
+  reused_count = len({record.index for record in all_results["results"] if record.cached})
+  if reused_count > 0:
+    output_str += f"\nYour code hasn't changed since an earlier run, so {reused_count} of the {len(all_tests)} tests reused their results from that run, and only new or changed tests (and the tests they rely on) were run.\n"
+  if config.get("resourceLimits") and "student" in resource_usage:
+    results_writer.add(get_resource_limits_feedback(resource_usage["student"]))
 
   if all_results["total"] != all_results["passed"]:
     output_str += "\nNot all available test cases passed your implementation. Please see the following breakdown.\n"
@@ -415,52 +2037,62 @@ def main():
   else:
     output_str += "\nAll available test cases passed your implementation!\n"
 
-  # Upload results to the database
-  upload_response = upload_results(assignment_title, student_id, [{"name": result["name"], "passed": result["result"]["success"]} for result in all_results["results"]])
-  if upload_response.status_code != 200:
-    output_str += "\nError uploading results to the database. Please contact the assignment administrators. You can still see the results of the test cases below, but the updated statistics have not been uploaded.\n"
+  # Upload results to the database, in a batch they are uploaded together with the other submissions' at the end
+  # Results that can't be uploaded now are queued and uploaded by a later run
+  result_records = [{"name": record.name, "passed": record.success} for record in all_results["results"] if not record.skipped]
+  upload = get_results_upload(assignment_title, student_id, result_records)
+  if database_error is not None:
+    queue_pending_upload(upload)
+  elif batch_job is not None:
+    with open(batch_job["uploadFile"], 'w') as file:
+      json.dump(upload, file)
+  else:
+    try:
+      upload_status = upload_results(upload).status_code
+    except requests.RequestException:
+      upload_status = None
+    if upload_status != 200:
+      # Only keep uploads that failed because of the connection or the database, the others would fail again
+      if (upload_status is None or upload_status >= 500) and queue_pending_upload(upload):
+        output_str += "\nError uploading results to the database. You can still see the results of the test cases below, and the updated statistics will be uploaded by a later submission.\n"
+      else:
+        output_str += "\nError uploading results to the database. Please contact the assignment administrators. You can still see the results of the test cases below, but the updated statistics have not been uploaded.\n"
   
-  write_output({"output": output_str, "tests": feedback})
+  results_writer.close(output_str)
 
 
 def setup():
   load_config()
+  start_grading_budget()
   
-  # Read default tests
-  try:
-    with open('/autograder/source/sample-submission/default-tests.json', 'r') as file:
-      tests = json.load(file)
-  except:
-    tests = []
+  # Read and check default tests
+  tests, test_errors = read_tests(f'{SAMPLE_DIR}/default-tests.json')
   
   output_str = ""
+  if len(test_errors) > 0:
+    output_str += get_test_errors_output("default-tests.json", test_errors)
   if len(tests) > 0:
-    # Run tests on sample submission
-    pre_pgid, err = pre_test("/autograder/source/sample-submission")
-    if err != "":
-      print("Error running pre-test script for sample submission:\n" + err)
-      return
-    sample_results = run_tests(tests)
-    err = post_test(pre_pgid, "/autograder/source/sample-submission")
-    if err != "":
-      print("Error running post-test script for sample submission::\n" + err)
-      return
+    # Run tests on sample submission, only starting it if some results aren't cached
+    sample_cache_dir = get_sample_cache_dir()
+    cached_results = load_cached_results(tests, sample_cache_dir)
+    all_cached = len(cached_results) == len(tests)
+    if not all_cached:
+      pre_pgid, err, startup_msg = pre_test(SAMPLE_DIR)
+      if err != "":
+        print("Error running pre-test script for sample submission:\n" + err)
+        return
+      if startup_msg:
+        output_str += "Sample solution: " + startup_msg
+    feedback = []
+    sample_results = run_tests(tests, cached_results=cached_results, cache_dir=sample_cache_dir, on_result=lambda plan, record, test_result: feedback.append(get_sample_feedback(plan, record, test_result)))
+    if not all_cached:
+      err = post_test(pre_pgid, SAMPLE_DIR)
+      if err != "":
+        print("Error running post-test script for sample submission::\n" + err)
+        return
+      output_str += get_resource_output(resource_usage.get("sample"), "The sample solution's server")
 
-    feedback = [{
-      "name": "SAMPLE SOLUTION RESULT: " + result["name"],
-      "status": "failed" if not result["result"]["success"] else "passed",
-      "score": 0 if not result["result"]["success"] else 0,
-      "max_score": 0,
-      "isDefault": False,
-      "output": "Description: " + result["test"]["description"] + "\n\n" + result["result"]["reason"] if "description" in result["test"] and result["test"]["description"] else result["result"]["reason"],
-      "visibility": "visible"
-    } for result in sample_results["results"]]
-    successful_tests = []
-    successful_test_names = []
-    for result in sample_results["results"]:
-      if result["result"]["success"] and result["test"]["name"] not in successful_test_names:
-        successful_tests.append(result["test"])
-        successful_test_names.append(result["test"]["name"])
+    successful_tests = get_successful_tests(tests, sample_results)
 
     if sample_results["total"] != sample_results["passed"]:
       output_str += "Some test cases did not pass sample implementation. Only test cases that pass this sample may be uploaded. You can find the outcomes of running your tests on THE SAMPLE SOLUTION below.\n"
@@ -483,7 +2115,11 @@ def setup():
   assignment_title = get_assignment_title()
 
   # Upload tests to the database, get response of all tests
-  response = upload_tests(assignment_title, "-1", successful_tests, config)
+  try:
+    response = upload_tests(assignment_title, "-1", successful_tests, config)
+  except requests.RequestException as e:
+    print(f"Error uploading tests to the database. Please contact the database administrators. The request failed: {e}\nIn the meantime, here are the outcomes of running your tests on THE SAMPLE SOLUTION.\n" + output_str + "\n" + test_response)
+    return
   if response.status_code < 200 or response.status_code >= 300:
     print(f"Error uploading tests to the database. Please contact the database administrators. Response status {response.status_code}:\n{response.text}\nIn the meantime, here are the outcomes of running your tests on THE SAMPLE SOLUTION.\n" + output_str + "\n" + test_response)
     return
@@ -499,17 +2135,233 @@ def setup():
   elif len(successful_tests) > 0:
     output_str += "All tests successfully uploaded to the database!\n"
 
+  # Keep the default tests, which submissions can still be graded with when the database can't be reached
+  server_tests, _ = get_bundle_tests(json_response, None)
+  default_tests = [test for test in server_tests if test.get("isDefault", False)]
+  save_bundle(assignment_title, None, {"etag": None, "savedAt": time.time(), "order": [], "tests": default_tests})
+
   print(output_str)
   print(test_response)
 
 
+# Batch regrades: grader.py --batch <dir> grades every submission in the directory, each in its own worker process
+
+BATCH_CONFIG = {"cacheSampleResults": True} # the sample solution's results are shared by every worker through the cache
+batch_job = None
+
+def load_batch_job():
+  # A worker started by --batch is pointed at its submission, ports and results with a job file instead of the /autograder layout
+  global batch_job, SUBMISSION_DIR, SAMPLE_RUN_DIR, RESULTS_DIR, METADATA_FILE
+  job_file = os.getenv('GRADER_BATCH_JOB')
+  if job_file is None:
+    return
+  with open(job_file, 'r') as file:
+    batch_job = json.load(file)
+  SUBMISSION_DIR = batch_job["submission"]
+  SAMPLE_RUN_DIR = batch_job["sample"] # results are still cached by the digest of the original SAMPLE_DIR
+  RESULTS_DIR = batch_job["results"]
+  METADATA_FILE = batch_job["metadata"]
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1)) # still clean up servers if the batch stops this worker
+
+
+def get_batch_config():
+  return config.get("batch") or {}
+
+
+def find_batch_submissions(batch_dir):
+  # Each submission is a directory laid out like /autograder: a submission folder and a submission_metadata.json next to it
+  names = []
+  for name in sorted(os.listdir(batch_dir)):
+    if os.path.isdir(os.path.join(batch_dir, name, "submission")) and os.path.isfile(os.path.join(batch_dir, name, "submission_metadata.json")):
+      names.append(name)
+  return names
+
+
+@traced
+def prepare_batch(batch_dir, names, port):
+  # Runs the tests of each submission on the sample solution, so the workers find their plans and sample results cached. Like a normal
+  # run, each submission's tests run in their own order on a freshly started sample solution, so they never see another submission's state
+  sample_cache_dir = get_sample_cache_dir()
+  for name in names:
+    plans, _ = read_tests(os.path.join(batch_dir, name, "submission", "tests.json"))
+    cached_results = load_cached_results(plans, sample_cache_dir)
+    if len(cached_results) == len(plans):
+      continue
+    pre_pgid, err, _ = pre_test(SAMPLE_DIR, port)
+    if err != "":
+      return err
+    run_tests(plans, cached_results=cached_results, cache_dir=sample_cache_dir, port=port)
+    err = post_test(pre_pgid, SAMPLE_DIR)
+    if err != "":
+      return err
+  return ""
+
+
+def run_batch_worker(batch_dir, name, slots, scratch_root, timeout):
+  slot = slots.get()
+  try:
+    scratch = os.path.join(scratch_root, f"worker-{slot}")
+    shutil.rmtree(os.path.join(scratch, "submission"), ignore_errors=True)
+    shutil.copytree(os.path.join(batch_dir, name, "submission"), os.path.join(scratch, "submission"), symlinks=True)
+    # Some sample results (e.g. load tests and timeouts) are never cached, so each worker may also start the sample solution.
+    # It gets its own copy, so pre-test.sh (e.g. npm install) never runs in the same directory twice at the same time
+    if not os.path.isdir(os.path.join(scratch, "sample-submission")):
+      shutil.copytree(SAMPLE_DIR, os.path.join(scratch, "sample-submission"), symlinks=True)
+    results_dir = os.path.join(batch_dir, name, "results")
+    os.makedirs(results_dir, exist_ok=True)
+    for stale_file in ["results.json", "upload.json"]:
+      if os.path.exists(os.path.join(results_dir, stale_file)):
+        os.remove(os.path.join(results_dir, stale_file)) # results.json would otherwise be merged with the last run's
+    port_base = get_batch_config().get("portBase", 4000)
+    job = {
+      "name": name,
+      "submission": os.path.join(scratch, "submission"),
+      "sample": os.path.join(scratch, "sample-submission"),
+      "results": results_dir,
+      "metadata": os.path.join(batch_dir, name, "submission_metadata.json"),
+      "samplePort": port_base + 1 + 2 * slot,
+      "studentPort": port_base + 2 + 2 * slot,
+      "uploadFile": os.path.join(results_dir, "upload.json")
+    }
+    with open(os.path.join(scratch, "job.json"), 'w') as file:
+      json.dump(job, file)
+
+    start = time.monotonic()
+    with open(os.path.join(results_dir, "grader.log"), 'w') as log:
+      process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], cwd=job["submission"], env=dict(os.environ, GRADER_BATCH_JOB=os.path.join(scratch, "job.json")), stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+      active_process_groups.add(process.pid)
+      try:
+        process.wait(timeout=timeout)
+        status = "graded" if process.returncode == 0 else f"error (exit code {process.returncode})"
+      except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGTERM) # the worker stops its own servers before exiting
+        try:
+          process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+          os.killpg(process.pid, signal.SIGKILL)
+          process.wait()
+        status = "timed out"
+      finally:
+        active_process_groups.discard(process.pid)
+    if status == "graded" and not os.path.exists(os.path.join(results_dir, "results.json")):
+      status = "error (no results.json)"
+    return {"name": name, "status": status, "seconds": time.monotonic() - start}
+  finally:
+    slots.put(slot)
+
+
+@traced
+def upload_batch_results(batch_dir, rows):
+  # Combines the workers' result uploads into one request per assignment for every batch uploadSize submissions
+  uploads = collections.defaultdict(list)
+  for row in rows:
+    try:
+      with open(os.path.join(batch_dir, row["name"], "results", "upload.json"), 'r') as file:
+        upload = json.load(file)
+    except (OSError, ValueError):
+      row["upload"] = "not run"
+      continue
+    uploads[upload["assignment"]].append((row, upload))
+
+  flush_pending_uploads()
+  for assignment_uploads in uploads.values():
+    statuses = upload_results_bulk([upload for _, upload in assignment_uploads])
+    for (row, upload), status in zip(assignment_uploads, statuses):
+      if status is not None and status["success"]:
+        row["upload"] = "uploaded"
+      elif "reason" not in (status or {}) and queue_pending_upload(upload):
+        row["upload"] = "queued"
+      else:
+        row["upload"] = "failed"
+
+
+def get_batch_summary(batch_dir, row):
+  summary = {"submission": row["name"], "students": "", "status": row["status"], "score": "", "max_score": "", "passed": "", "failed": "", "upload": row.get("upload", ""), "seconds": f"{row['seconds']:.1f}"}
+  try:
+    with open(os.path.join(batch_dir, row["name"], "submission_metadata.json"), 'r') as file:
+      summary["students"] = ";".join(user["email"] for user in json.load(file)["users"])
+  except (OSError, ValueError, KeyError, TypeError):
+    pass
+  try:
+    with open(os.path.join(batch_dir, row["name"], "results", "results.json"), 'r') as file:
+      tests = json.load(file).get("tests", [])
+  except (OSError, ValueError):
+    return summary
+  summary["score"] = sum(test.get("score", 0) for test in tests)
+  summary["max_score"] = sum(test.get("max_score", 0) for test in tests)
+  summary["passed"] = sum(1 for test in tests if test.get("status") == "passed")
+  summary["failed"] = sum(1 for test in tests if test.get("status") == "failed")
+  return summary
+
+
+def run_batch(batch_dir):
+  global RESULTS_DIR
+  batch_dir = os.path.abspath(batch_dir)
+  RESULTS_DIR = batch_dir # where the batch's own trace is written
+  load_config()
+  config.update(BATCH_CONFIG)
+  names = find_batch_submissions(batch_dir)
+  if len(names) == 0:
+    print(f"No submissions found in {batch_dir}. Each submission should be a directory with a submission folder and a submission_metadata.json file.")
+    return
+  workers = min(get_batch_config().get("workers", os.cpu_count() or 1), len(names))
+  print(f"Grading {len(names)} submissions with {workers} workers")
+
+  err = prepare_batch(batch_dir, names, get_batch_config().get("portBase", 4000))
+  if err != "":
+    print("Error running the sample solution, no submissions were graded:\n" + err)
+    return
+
+  slots = queue.Queue()
+  for slot in range(workers):
+    slots.put(slot)
+  timeout = config["gradingBudget"] + config.get("budgetGracePeriod", 60) + 30 if config.get("gradingBudget") is not None else None
+  scratch_root = tempfile.mkdtemp(prefix="grader-batch-")
+  try:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+      futures = [executor.submit(run_batch_worker, batch_dir, name, slots, scratch_root, timeout) for name in names]
+      rows = []
+      for future in futures:
+        rows.append(future.result())
+        print(f"{rows[-1]['name']}: {rows[-1]['status']} in {rows[-1]['seconds']:.1f} seconds")
+  finally:
+    shutil.rmtree(scratch_root, ignore_errors=True)
+
+  upload_batch_results(batch_dir, rows)
+  summaries = [get_batch_summary(batch_dir, row) for row in rows]
+  with open(os.path.join(batch_dir, "results.csv"), 'w', newline='') as file:
+    writer = csv.DictWriter(file, fieldnames=list(summaries[0]))
+    writer.writeheader()
+    writer.writerows(summaries)
+  graded = sum(1 for row in rows if row["status"] == "graded")
+  print(f"Graded {graded} of {len(rows)} submissions, see {os.path.join(batch_dir, 'results.csv')}")
+
+
+def run_instrumented(function):
+  # Set GRADER_PROFILE=1 to also profile the grader itself
+  profile = cProfile.Profile() if os.getenv('GRADER_PROFILE') else None
+  if profile is not None:
+    profile.enable()
+  try:
+    function()
+  finally:
+    if profile is not None:
+      profile.disable()
+      profile.dump_stats(os.getenv('GRADER_PROFILE_FILE', f'{RESULTS_DIR}/grader.prof'))
+      pstats.Stats(profile).sort_stats('cumulative').print_stats(25)
+    kill_active_process_groups() # servers left running by an early return
+    write_trace()
+
+
 if __name__ == "__main__":
   if len(sys.argv) == 2:
     if sys.argv[1] == "--setup":
-      setup()
+      run_instrumented(setup)
     else:
-      print("Invalid argument. Use --setup in autograder setup.")
+      print("Invalid argument. Use --setup in autograder setup, or --batch <dir> to regrade a directory of submissions.")
+  elif len(sys.argv) == 3 and sys.argv[1] == "--batch":
+    run_instrumented(functools.partial(run_batch, sys.argv[2]))
   elif len(sys.argv) == 1:
-    main()
+    run_instrumented(main)
   else:
-    print("Invalid number of arguments. Use --setup in autograder setup.")
+    print("Invalid number of arguments. Use --setup in autograder setup, or --batch <dir> to regrade a directory of submissions.")
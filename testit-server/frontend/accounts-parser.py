@@ -1,24 +1,120 @@
-import pandas as pd
+import argparse
 import json
+import os
+
+import pandas as pd
+import requests
+
+# Turns the roster .csv downloaded from Gradescope into testit accounts. By default they are written to accounts.json, and with --sync
+# they are compared with the accounts on a running server, which are then only created or deleted where they differ
+
+ACCOUNT_COLUMNS = ['username', 'id', 'admin']
+
+
+def read_roster(path, chunk_size, domain):
+    # The roster is read in chunks, so large rosters with many sections are never loaded all at once. Students without an SID or an
+    # email are skipped, as are non-Penn emails, since the username is the Pennkey at the start of the email
+    accounts = []
+    for chunk in pd.read_csv(path, usecols=['Email', 'SID'], dtype=str, chunksize=chunk_size):
+        emails = chunk['Email'].str.strip()
+        sids = pd.to_numeric(chunk['SID'].str.strip(), errors='coerce') # also reads SIDs like "12345678.0"
+        keep = emails.notna() & sids.notna() & emails.str.contains(domain, regex=False, na=False)
+        emails, sids = emails[keep], sids[keep]
+        accounts.append(pd.DataFrame({
+            'username': emails.str.split('@').str[0],
+            'id': emails,
+            'admin': False,
+            'password': sids.astype('int64').astype(str)
+        }))
+    if len(accounts) == 0:
+        return pd.DataFrame(columns=ACCOUNT_COLUMNS + ['password'])
+    return pd.concat(accounts, ignore_index=True).drop_duplicates('username', keep='last')
+
+
+def read_extra_accounts(path):
+    # Accounts that aren't in the roster, like the admin account and students with non-Penn emails
+    if path is None:
+        return pd.DataFrame(columns=ACCOUNT_COLUMNS + ['password'])
+    with open(path, 'r') as file:
+        extra = pd.DataFrame(json.load(file), columns=ACCOUNT_COLUMNS + ['password'])
+    extra['admin'] = extra['admin'].eq(True)
+    return extra
+
+
+def get_account_changes(accounts, existing):
+    # Accounts are compared by username, id and admin (passwords are only stored hashed). Admin accounts are never deleted
+    existing = existing.reindex(columns=ACCOUNT_COLUMNS)
+    existing['admin'] = existing['admin'].eq(True)
+    merged = accounts.merge(existing, on=ACCOUNT_COLUMNS, how='outer', indicator=True)
+    to_delete = merged.loc[(merged['_merge'] == 'right_only') & ~merged['admin'], ['username']]
+    remaining = existing[~existing['username'].isin(to_delete['username'])]
+    to_create = merged.loc[merged['_merge'] == 'left_only', ACCOUNT_COLUMNS + ['password']]
+    conflicts = to_create[to_create['username'].isin(remaining['username'])]
+    to_create = to_create[~to_create['username'].isin(remaining['username'])]
+    return to_create, to_delete, conflicts
+
+
+def get_batches(accounts, batch_size):
+    for start in range(0, len(accounts), batch_size):
+        yield accounts.iloc[start:start + batch_size].to_dict(orient='records')
+
+
+def sync_accounts(accounts, server, token, batch_size, dry_run):
+    session = requests.Session()
+    session.headers.update({'Authorization': token})
+    response = session.get(f"{server}/list-accounts", timeout=60)
+    response.raise_for_status()
+    to_create, to_delete, conflicts = get_account_changes(accounts, pd.DataFrame(response.json(), columns=ACCOUNT_COLUMNS))
+
+    for username in conflicts['username']:
+        print(f"Skipping {username}, an admin account with the same username already exists")
+    print(f"{len(to_create)} accounts to create, {len(to_delete)} accounts to delete")
+    if dry_run:
+        for username in to_delete['username']:
+            print(f"Would delete {username}")
+        for username in to_create['username']:
+            print(f"Would create {username}")
+        return
+
+    # Deleted first, so an account whose email changed can be created again with the same username
+    for batch in get_batches(to_delete, batch_size):
+        response = session.delete(f"{server}/delete-accounts", json=batch, timeout=300)
+        if response.status_code not in (200, 404): # 404 means they were already deleted
+            response.raise_for_status()
+        print(response.text)
+    for batch in get_batches(to_create, batch_size):
+        response = session.post(f"{server}/create-accounts", json=batch, timeout=300)
+        response.raise_for_status()
+        print(response.text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create testit accounts from a Gradescope roster")
+    parser.add_argument('roster', nargs='?', default='accounts.csv', help="the roster .csv downloaded from Gradescope (accounts.csv by default)")
+    parser.add_argument('--output', default='accounts.json', help="where to write the accounts when not syncing (accounts.json by default)")
+    parser.add_argument('--extra', help="a .json file of accounts to add that aren't in the roster, in the same format as accounts.json")
+    parser.add_argument('--domain', default='upenn.edu', help="only students with emails in this domain are added (upenn.edu by default)")
+    parser.add_argument('--chunk-size', type=int, default=10000, help="number of roster rows read at a time")
+    parser.add_argument('--sync', action='store_true', help="create and delete accounts on the server so it matches the roster, instead of writing them to a file")
+    parser.add_argument('--server', default=f"http://{os.getenv('SERVER_IP', 'localhost')}:{os.getenv('SERVER_PORT', '3000')}", help="the testit server to sync with (from SERVER_IP and SERVER_PORT by default)")
+    parser.add_argument('--token', default=os.getenv('AUTH_TOKEN'), help="the server's AUTH_TOKEN (from the environment by default)")
+    parser.add_argument('--batch-size', type=int, default=500, help="largest number of accounts created or deleted in one request")
+    parser.add_argument('--dry-run', action='store_true', help="with --sync, only print the changes")
+    args = parser.parse_args()
+
+    roster = read_roster(args.roster, args.chunk_size, args.domain)
+    print(f"{len(roster)} accounts in the roster")
+    extra = read_extra_accounts(args.extra)
+    accounts = pd.concat([roster[~roster['username'].isin(extra['username'])], extra], ignore_index=True)
+
+    if args.sync:
+        if args.token is None:
+            parser.error("--sync needs the server's AUTH_TOKEN, with --token or the AUTH_TOKEN environment variable")
+        sync_accounts(accounts, args.server, args.token, args.batch_size, args.dry_run)
+    else:
+        with open(args.output, 'w') as json_file:
+            json.dump(accounts.to_dict(orient='records'), json_file, indent=2)
+
 
-excel_data = pd.read_csv('accounts.csv')
-
-json_output = []
-count = 0
-for index, row in excel_data.iterrows():
-    if pd.notnull(row['SID']) and pd.notnull(row['Email']) and 'upenn.edu' in row['Email']:
-        username = row['Email'].split('@')[0]
-        json_object = {
-            "username": username,
-            "id": row['Email'],
-            "admin": False,
-            "password": str(int(row['SID']))
-        }
-        json_output.append(json_object)
-        count += 1
-
-json_data = json.dumps(json_output, indent=2)
-
-with open('accounts.json', 'w') as json_file:
-    json_file.write(json_data)
-print(count)
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,8 @@ const jwt = require('jsonwebtoken');
 const cors = require('cors');
 const _ = require('lodash');
 const mongodb = require('mongodb');
+const crypto = require('crypto');
+const zlib = require('zlib');
 const MongoClient = mongodb.MongoClient;
 const app = express();
 app.use(cors());
@@ -128,6 +130,17 @@ app.delete('/delete-accounts', authorize, express.json(), async (req, res) => {
   }
 });
 
+// Every account without its password, so a roster can be synced with only the accounts that changed
+app.get('/list-accounts', authorize, async (req, res) => {
+  const users = db.collection('users');
+  try {
+    const accounts = await users.find({}, { projection: { _id: 0, username: 1, id: 1, admin: 1 } }).toArray();
+    res.status(200).send(accounts);
+  } catch (err) {
+    res.status(500).send('Failed to list accounts');
+  }
+});
+
 app.post('/login', express.json(), async (req, res) => {
   if (!req.body) {
     return res.status(400).send('No credentials provided');
@@ -182,7 +195,7 @@ app.get('/get-tests/:assignmentName', authenticateToken, (req, res) => {
       return;
     }
 
-    items = items.map(item => ({
+    items = items.map(({ appliedKeys, ...item }) => ({
       ...item,
       numLiked: Array.isArray(item.studentsLiked) ? item.studentsLiked.length : 0,
       numDisliked: Array.isArray(item.studentsDisliked) ? item.studentsDisliked.length : 0,
@@ -274,7 +287,13 @@ app.post('/submit-tests/:assignmentName', authorize, express.json(), async (req,
     }
   });
 
+  // Graders that keep the returned tests send { tests, knownTests }, with the hashes of the tests they already have
   let testCases = req.body;
+  let knownTests = null;
+  if (!Array.isArray(testCases)) {
+    knownTests = new Set(req.body.knownTests || []);
+    testCases = req.body.tests || [];
+  }
 
   if (!req.query.id) {
     return res.status(400).send('Error: Author is required as a query parameter.');
@@ -294,7 +313,8 @@ app.post('/submit-tests/:assignmentName', authorize, express.json(), async (req,
     numPublicTestsForAccess = 1,
     maxTestsPerStudent = 10,
     maxNumReturnedTests = 100,
-    weightReturnedTests = false
+    weightReturnedTests = false,
+    stableTestSample = false
   } = req.query;
 
   if (user.admin) {
@@ -305,7 +325,10 @@ app.post('/submit-tests/:assignmentName', authorize, express.json(), async (req,
   const existingTestCount = await collection.countDocuments({ author: author });
   const remainingTests = maxTestsPerStudent - existingTestCount;
 
-  if (remainingTests <= 0) {
+  // Tests the author already has are only updated, so they don't count against the limit. This also keeps a retried upload whose
+  // first attempt already added the tests from being rejected
+  const ownTestNames = new Set((await collection.find({ author: author, name: { $in: testCases.map(testCase => testCase.name) } }, { projection: { name: 1 } }).toArray()).map(test => test.name));
+  if (remainingTests <= 0 && !testCases.every(testCase => ownTestNames.has(testCase.name))) {
     return res.status(400).send(`Error: Maximum number of tests per student (${maxTestsPerStudent}) exceeded.`);
   }
 
@@ -324,6 +347,8 @@ app.post('/submit-tests/:assignmentName', authorize, express.json(), async (req,
     testCase.studentsRanSuccessfully = [];
     testCase.studentsLiked = [];
     testCase.studentsDisliked = [];
+    testCase.recentResults = [];
+    testCase.appliedKeys = [];
     testCase.createdAt = new Date();
     testCase.public ??= true;
     testCase.visibility = "limited"; // 3 options, full (actual content of test can be seen), limited (only name, description, and feedback), none (only author can see)
@@ -373,18 +398,41 @@ app.post('/submit-tests/:assignmentName', authorize, express.json(), async (req,
     let authorsTests = tests.filter(test => !test.isDefault && test.author === author);
     let studentTests = tests.filter(test => !test.isDefault && test.author !== author);
     if (studentTests.length > maxNumReturnedTests) {
+      // With stableTestSample, the sample only changes when the available tests do, so the grader's cached copy of them stays valid
+      // between submissions. Otherwise every submission gets a new random sample
+      const random = String(stableTestSample).toLowerCase() === 'true' ? seededRandom(author + "\n" + studentTests.map(test => test.name).sort().join("\n")) : Math.random;
       if (weightReturnedTests) { // use weighted sampling by number of likes
         studentTests = studentTests.map(test => ({ ...test, weight: test.studentsLiked.length + 1 }));
-        studentTests = weightedRandomSample(studentTests, maxNumReturnedTests); // TODO: make this more efficient?
+        studentTests = weightedRandomSample(studentTests, maxNumReturnedTests, random); // TODO: make this more efficient?
         studentTests = studentTests.map(({ weight, ...testWithoutWeight }) => testWithoutWeight);
       } else { // use simple random sampling
-        studentTests = studentTests.sort(() => 0.5 - Math.random()).slice(0, maxNumReturnedTests);
+        studentTests = shuffle(studentTests, random).slice(0, maxNumReturnedTests);
       }
     }
 
+    // The statistics change on every run, so they are summarized separately for the grader to decide which tests to run first
     result.tests = defaultTests.concat(authorsTests).concat(studentTests);
-    result.tests = result.tests.map(test => ({ ...test, selfWritten: test.author === author }));
-    res.status(201).send(result);
+    result.history = Object.fromEntries(result.tests.map(test => [test.name, getTestHistory(test)]));
+    result.tests = result.tests.map(({ _id, timesRan, timesRanSuccessfully, numStudentsRan, numStudentsRanSuccessfully, studentsRan, studentsRanSuccessfully, studentsLiked, studentsDisliked, recentResults, appliedKeys, ...test }) => ({ ...test, selfWritten: test.author === author }));
+
+    if (knownTests !== null) {
+      // Only send the tests the grader doesn't have yet, or nothing if it already has exactly these
+      const hashes = result.tests.map(hashTest);
+      result.etag = `"${crypto.createHash('sha256').update(hashes.join(",")).digest('hex')}"`;
+      if (req.headers['if-none-match'] === result.etag) {
+        result.notModified = true;
+      } else {
+        result.order = hashes;
+        result.newTests = {};
+        result.tests.forEach((test, i) => {
+          if (!knownTests.has(hashes[i])) {
+            result.newTests[hashes[i]] = test;
+          }
+        });
+      }
+      delete result.tests;
+    }
+    sendJson(req, res, 201, result);
   } catch (err) {
     result.success = false;
     console.log("Failed to upload tests:", err)
@@ -409,12 +457,66 @@ function isTestSame(newTest, oldTest) {
   return true;
 }
 
-function weightedRandomSample(items, maxItems) {
+const RECENT_RESULTS = 20;
+const APPLIED_KEYS = 200; // upload keys remembered by each test
+
+// How often a test fails, and how often its outcome changed between its recent runs
+function getTestHistory(test) {
+  const recent = test.recentResults || [];
+  let flips = 0;
+  for (let i = 1; i < recent.length; i++) {
+    if (recent[i] !== recent[i - 1]) {
+      flips++;
+    }
+  }
+  return {
+    failureRate: test.timesRan > 0 ? Math.round(1000 * (1 - test.timesRanSuccessfully / test.timesRan)) / 1000 : 0,
+    flakiness: recent.length > 1 ? Math.round(1000 * flips / (recent.length - 1)) / 1000 : 0
+  };
+}
+
+function hashTest(test) {
+  return crypto.createHash('sha256').update(JSON.stringify(test)).digest('hex').slice(0, 32);
+}
+
+// Sends a JSON response, compressed with gzip if the client accepts it and it's worth it
+function sendJson(req, res, status, body) {
+  const json = JSON.stringify(body);
+  res.status(status).type('application/json');
+  if (json.length > 1024 && /\bgzip\b/.test(req.headers['accept-encoding'] || '')) {
+    res.set('Content-Encoding', 'gzip');
+    res.set('Vary', 'Accept-Encoding');
+    return res.send(zlib.gzipSync(json));
+  }
+  res.send(json);
+}
+
+// Deterministic random numbers in [0, 1) from a seed (mulberry32)
+function seededRandom(seed) {
+  let state = crypto.createHash('sha256').update(seed).digest().readUInt32LE(0);
+  return () => {
+    state = (state + 0x6D2B79F5) | 0;
+    let t = Math.imul(state ^ (state >>> 15), 1 | state);
+    t = (t + Math.imul(t ^ (t >>> 7), 61 | t)) ^ t;
+    return ((t ^ (t >>> 14)) >>> 0) / 4294967296;
+  };
+}
+
+function shuffle(items, random) {
+  items = items.slice();
+  for (let i = items.length - 1; i > 0; i--) {
+    const j = Math.floor(random() * (i + 1));
+    [items[i], items[j]] = [items[j], items[i]];
+  }
+  return items;
+}
+
+function weightedRandomSample(items, maxItems, random = Math.random) {
   let totalWeight = items.reduce((acc, item) => acc + item.weight, 0);
   let weightedSamples = [];
 
   for (let i = 0; i < maxItems && items.length > 0; i++) {
-    let randomWeight = Math.random() * totalWeight;
+    let randomWeight = random() * totalWeight;
     let weightSum = 0;
 
     for (let j = 0; j < items.length; j++) {
@@ -431,6 +533,48 @@ function weightedRandomSample(items, maxItems) {
   return weightedSamples;
 }
 
+// Records one student's results (a list of { name, passed }), returns the tests that could not be updated and the number of tests
+// that were newly updated. With a key, each test stores the key in appliedKeys in the same update that counts the result, so an upload
+// that is retried with the same key (even after only some of its results were recorded) counts each result exactly once
+async function recordResults(collection, author, data, key = null) {
+  const failedToUpdate = [];
+  let recorded = 0;
+  for (const testResult of data) {
+    try {
+      // Increment timesRan and timesRanSuccessfully, and keep the most recent outcomes
+      const update = { $inc: { timesRan: 1, timesRanSuccessfully: testResult.passed ? 1 : 0 }, $push: { recentResults: { $each: [!!testResult.passed], $slice: -RECENT_RESULTS } } };
+      if (key) {
+        update.$push.appliedKeys = { $each: [key], $slice: -APPLIED_KEYS }; // retries come soon after, so only the latest keys are kept
+      }
+      const { matchedCount } = await collection.updateOne(key ? { name: testResult.name, appliedKeys: { $ne: key } } : { name: testResult.name }, update);
+      recorded += matchedCount;
+
+      // Update numStudentsRan and numStudentsRanSuccessfully only if this student has not run this test before. These updates only
+      // match if the student isn't counted yet, so they are also safe to repeat
+      await collection.updateOne(
+        { name: testResult.name, studentsRan: { $ne: author } },
+        { $inc: { numStudentsRan: 1 }, $addToSet: { studentsRan: author } }
+      );
+      if (testResult.passed) {
+        await collection.updateOne(
+          { name: testResult.name, studentsRanSuccessfully: { $ne: author } },
+          { $inc: { numStudentsRanSuccessfully: 1 }, $addToSet: { studentsRanSuccessfully: author } }
+        );
+      }
+    } catch (err) {
+      console.log("Error updating test result for:", testResult.name, err);
+      failedToUpdate.push({ "name": testResult.name, "reason": "Error in updating the database." });
+    }
+  }
+  return { failedToUpdate: failedToUpdate, recorded: recorded };
+}
+
+// Like recordResults, but a retried upload with the same key is only recorded once. It is a duplicate if none of its results were new
+async function recordResultsOnce(collection, author, key, data) {
+  const { failedToUpdate, recorded } = await recordResults(collection, author, data, key || null);
+  return { failedToUpdate: failedToUpdate, duplicate: Boolean(key) && data.length > 0 && recorded === 0 && failedToUpdate.length === 0 };
+}
+
 app.post('/submit-results/:assignmentName', authorize, express.json(), async (req, res) => {
   const assignmentName = req.params.assignmentName;
   const collection = db.collection(`tests-${assignmentName}`);
@@ -451,41 +595,38 @@ app.post('/submit-results/:assignmentName', authorize, express.json(), async (re
   const author = user.username;
   console.log("Author is " + author);
 
-  const result = { failedToUpdate: [] };
-  for (const testResult of data) {
-    try {
-      // Increment timesRan and timesRanSuccessfully
-      await collection.updateOne(
-        { name: testResult.name },
-        { $inc: { timesRan: 1, timesRanSuccessfully: testResult.passed ? 1 : 0 } }
-      );
+  const result = await recordResultsOnce(collection, author, req.query.key, data);
+  result.success = result.failedToUpdate.length === 0;
+  res.status(result.success ? 200 : 500).send(result);
+});
 
-      // Update numStudentsRan and numStudentsRanSuccessfully only if this student has not run this test before
-      const updateFields = {};
-      const addToSetFields = { $addToSet: {} };
+// Results of many submissions at once (used when regrading a batch), a list of { id, key, results } where id and key are like in /submit-results
+app.post('/submit-results-bulk/:assignmentName', authorize, express.json({ limit: '50mb' }), async (req, res) => {
+  const assignmentName = req.params.assignmentName;
+  const collection = db.collection(`tests-${assignmentName}`);
 
-      const testCase = await collection.findOne({ name: testResult.name });
-      if (testCase && !testCase.studentsRan.includes(author)) {
-        updateFields.numStudentsRan = 1;
-        addToSetFields.$addToSet.studentsRan = author;
-      }
-      if (testResult.passed && testCase && !testCase.studentsRanSuccessfully.includes(author)) {
-        updateFields.numStudentsRanSuccessfully = 1;
-        addToSetFields.$addToSet.studentsRanSuccessfully = author;
-      }
+  if (!Array.isArray(req.body)) {
+    return res.status(400).send('Error: Expected a list of submissions.');
+  }
+  console.log(`Recieving results of ${req.body.length} submissions`);
 
-      await collection.updateOne(
-        { name: testResult.name },
-        { $inc: updateFields, ...addToSetFields }
-      );
-    } catch (err) {
-      console.log("Error updating test result for:", testResult.name, err);
-      result.failedToUpdate.push({ "name": testResult.name, "reason": "Error in updating the database." });
+  const submissions = [];
+  for (const submission of req.body) {
+    if (!submission.id || !Array.isArray(submission.results)) {
+      submissions.push({ id: submission.id, success: false, reason: "Submission must have an id and a list of results." });
+      continue;
     }
+    let decoded_id = Buffer.from(submission.id, 'base64').toString('ascii');
+    let user = await db.collection('users').findOne({ id: decoded_id });
+    if (!user) {
+      submissions.push({ id: submission.id, success: false, reason: "User not found" });
+      continue;
+    }
+    const { failedToUpdate, duplicate } = await recordResultsOnce(collection, user.username, submission.key, submission.results);
+    submissions.push({ id: submission.id, success: failedToUpdate.length === 0, failedToUpdate: failedToUpdate, duplicate: duplicate });
   }
 
-  result.success = result.failedToUpdate.length === 0;
-  res.status(result.success ? 200 : 500).send(result);
+  res.status(200).send({ success: submissions.every(submission => submission.success), submissions: submissions });
 });
 
 app.post('/like-test/:assignmentName/:testId', authenticateToken, async (req, res) => {